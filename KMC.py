@@ -6,12 +6,20 @@ Created on Wed Jan 17 17:43:50 2024
 """
 from balanced_tree import Node, build_tree, update_data, search_value
 import numpy as np
+from itertools import chain
 
 def KMC(System_state,rng):
         
     time_step = 0
     grid_crystal = System_state.grid_crystal
     superbasin_dict = System_state.superbasin_dict
+    rate_rescaling = System_state.rate_rescaling
+    first_passage = System_state.first_passage
+    walkers = first_passage.walkers
+    # Rates are constant until the next change of temperature (inf without schedule)
+    next_update = System_state.temperature_schedule.next_update
+    # Hybrid tau-leaping: the adsorption is not in the catalog, it is leaped between events
+    tau_leaping = System_state.tau_leaping > 0
 
 # =============================================================================
 #     TR_catalog store:
@@ -20,14 +28,25 @@ def KMC(System_state,rng):
 #      - TR_catalog[2] = Event label - Migration, desorption, etc
 #      - TR_catalog[3] = Starting site
 # =============================================================================
-    TR_catalog = []
-
-    for idx in System_state.sites_occupied + System_state.adsorption_sites:
+    # AS-KMC: rates of the quasi-equilibrated processes scaled down
+    if rate_rescaling.active and rate_rescaling.scaling:
+        TR_catalog = rate_rescaling.rescaled_catalog(System_state)
+        if tau_leaping:
+            TR_catalog = [item for item in TR_catalog if item[2] != System_state.num_event - 1]
         
-        if idx not in superbasin_dict:
-            TR_catalog.extend([(item[0],item[1],item[2],idx) for item in grid_crystal[idx].site_events])
-        else:
-            TR_catalog.extend([(item[0],item[1],item[2],idx) for item in superbasin_dict[idx].site_events_absorbing])
+    else:
+        TR_catalog = []
+    
+        # Inert sites (buried particles without events) are not in active_sites
+        for idx in (System_state.active_sites if tau_leaping else chain(System_state.active_sites,System_state.adsorption_sites)):
+            
+            # First-passage walkers move with their exit
+            if idx in walkers: continue
+            
+            if idx not in superbasin_dict:
+                TR_catalog.extend([(item[0],item[1],item[2],idx) for item in grid_crystal[idx].site_events])
+            else:
+                TR_catalog.extend([(item[0],item[1],item[2],idx) for item in superbasin_dict[idx].site_events_absorbing])
 
 
     # Sort the list of events
@@ -38,29 +57,173 @@ def KMC(System_state,rng):
     TR_tree = build_tree(TR_catalog)
     # Each node is the sum of their children, starting from the leaf
     sumTR = update_data(TR_tree)
-    
-
-    if sumTR == None: return System_state,time_step # Exit if there is not possible event
     # When we only have one node in the tree, it returns a tuple
     if type(sumTR) is tuple: sumTR = sumTR[0]
-    # We search in our binary tree the event that happen
-
-    chosen_event = search_value(TR_tree,sumTR*rng.random())
-
-    #Calculate the time step
-    time_step += -np.log(rng.random())/sumTR
-    # If the time step is big because of the TR, we need to allow the deposition process to occur
-    # We establish a time step limits that the deposition is relevant
-    if time_step > System_state.timestep_limits:
-        time_step = System_state.timestep_limits
-        if rng.random() < 1-np.exp(-sumTR*time_step):
-            System_state.processes(chosen_event)
+    
+# =============================================================================
+#     Adsorption leaps: the adsorption is not in the catalog, it is leaped in windows
+#     of at most tau and the rest of events are exact KMC (tau_leap())
+#      - Hybrid tau-leaping: tau = tau_leaping / TR_gen
+#      - Slow regime: the mean time step (adsorption included) is longer than
+#        timestep_limits, tau = timestep_limits
+# =============================================================================
+    leap = tau_leaping
+    tau = System_state.tau_leaping / System_state.TR_gen if tau_leaping else System_state.timestep_limits
+    if not tau_leaping and sumTR is not None and sumTR * tau < 1:
+        leap = True
+        TR_catalog = [item for item in TR_catalog if item[2] != System_state.num_event - 1]
+        TR_tree = build_tree(TR_catalog)
+        sumTR = update_data(TR_tree)
+        if type(sumTR) is tuple: sumTR = sumTR[0]
 
+    if sumTR == None: 
+        # Only first-passage walkers or adsorption leaps
+        if not walkers and not (leap and len(System_state.adsorption_sites)):
+            return System_state,time_step # Exit if there is not possible event
+        chosen_event = None
+        time_step = np.inf
     else:
-        System_state.processes(chosen_event)
-        
+        # We search in our binary tree the event that happen
+        chosen_event = search_value(TR_tree,sumTR*rng.random())
+        #Calculate the time step
+        time_step += rng.exponential()/sumTR
+    
+    # First-passage: a walker leaves its domain before the next event (or the end of the leap)
+    time_limit = min(System_state.time + (min(time_step,tau) if leap else time_step),next_update)
+    if walkers and time_limit >= first_passage.next_exit().exit_time:
+        return first_passage_exit(System_state,rng)
+    
+    # Temperature schedule: the next event happens after the change of temperature.
+    # Nothing happens before (memoryless) and the rates change
+    if time_limit >= next_update: return temperature_update(System_state,leap,rng)
+    
+    if leap: return tau_leap(System_state,time_step,chosen_event,tau,rng)
+    
+    execute_event(System_state,chosen_event,time_step,rng)
     System_state.track_time(time_step)  
     System_state.update_superbasin(chosen_event)
     
 
+    return System_state,time_step
+
+def adsorption_leap(System_state,time_step,rng):
+    
+# =============================================================================
+#     Poisson leap for the adsorption within the window time_step
+#     - Particles arrive at each adsorption site with rate TR_gen (Poisson process)
+#     - A site only accepts the first particle, so the number of sites with some
+#       arrival is Binomial(adsorption sites, 1-exp(-TR_gen*time_step)) and these
+#       sites are a uniform sample of the adsorption sites
+#     - All of them are introduced at once (one update of the sites)
+# =============================================================================
+    adsorption_sites = System_state.adsorption_sites
+    if not len(adsorption_sites): return []
+    
+    n_adsorption = rng.binomial(len(adsorption_sites),1-np.exp(-System_state.TR_gen*time_step))
+    if n_adsorption == 0: return []
+    sites = [adsorption_sites[i] for i in rng.choice(len(adsorption_sites),n_adsorption,replace = False)]
+    
+    # First-passage: walkers with the adsorption sites in their domain
+    first_passage = System_state.first_passage
+    walker_sites = []
+    if first_passage.walkers:
+        for idx in sites:
+            walker_sites.extend(first_passage.disrupt((System_state.TR_gen,idx,System_state.num_event - 1,idx),
+                                                      System_state.time + time_step,System_state,rng))
+        sites = [idx for idx in sites if idx in adsorption_sites]
+    
+    System_state.deposition_sites(sites)
+    
+    for idx in sites:
+        System_state.update_superbasin((System_state.TR_gen,idx,System_state.num_event - 1,idx))
+    if first_passage.active:
+        for idx in sites + walker_sites:
+            first_passage.protect(idx,System_state,rng,System_state.time + time_step)
+            
+    return sites
+
+def tau_leap(System_state,time_step,chosen_event,tau,rng):
+    
+# =============================================================================
+#     Adsorption leaps (hybrid tau-leaping and slow regime)
+#     - The adsorption (uniform TR_gen over adsorption_sites) is advanced by leaps
+#       of time tau. In hybrid tau-leaping the leap is bounded so the expected number
+#       of particles adsorbed is at most a fraction tau_leaping of the adsorption sites:
+#           tau <= tau_leaping / TR_gen
+#       so the adsorption rate (number of adsorption sites) does not change much
+#       within a leap. In the slow regime tau = timestep_limits
+#     - The other events are exact KMC: if the next event happens within tau, we
+#       leap the adsorption until the event and then execute it (if the adsorbed
+#       particles did not make it impossible). Otherwise we only leap tau
+# =============================================================================
+    if time_step > tau:
+        time_step = tau
+        chosen_event = None
+        
+    adsorption_leap(System_state,time_step,rng)
+    
+    if chosen_event is not None and event_possible(System_state,chosen_event):
+        execute_event(System_state,chosen_event,time_step,rng)
+        System_state.update_superbasin(chosen_event)
+        
+    System_state.track_time(time_step)
+    
+    return System_state,time_step
+
+def event_possible(System_state,chosen_event):
+
+    # The event is still in the catalog after other changes in the system
+    idx_origin = chosen_event[-1]
+    if chosen_event[2] == System_state.num_event - 1: # Deposition
+        return idx_origin in System_state.adsorption_sites and System_state.grid_crystal[idx_origin].chemical_specie == 'Empty'
+
+    if idx_origin in System_state.superbasin_dict:
+        site_events = System_state.superbasin_dict[idx_origin].site_events_absorbing
+    else:
+        site_events = System_state.grid_crystal[idx_origin].site_events
+    return any(event[1] == chosen_event[1] and event[2] == chosen_event[2] for event in site_events)
+
+def execute_event(System_state,chosen_event,time_step,rng):
+    
+    first_passage = System_state.first_passage
+    walker_sites = []
+    
+    # First-passage: the walkers whose domain is affected by the event are placed
+    # where they are at the time of the event. The event might not be possible anymore
+    if first_passage.walkers:
+        walker_sites = first_passage.disrupt(chosen_event,System_state.time + time_step,System_state,rng)
+        if walker_sites and not event_possible(System_state,chosen_event):
+            return
+    
+    if System_state.rate_rescaling.active: System_state.rate_rescaling.record_event(chosen_event,System_state)
+    System_state.processes(chosen_event)
+    
+    if first_passage.active:
+        for idx in [chosen_event[1]] + walker_sites:
+            first_passage.protect(idx,System_state,rng,System_state.time + time_step)
+            
+def temperature_update(System_state,leap,rng):
+    
+    # The clock jumps to the next interval of the temperature schedule
+    schedule = System_state.temperature_schedule
+    time_step = schedule.next_update - System_state.time
+    
+    # Adsorption leaps: the adsorption is not in the catalog
+    if leap: adsorption_leap(System_state,time_step,rng)
+    System_state.track_time(time_step)
+    schedule.update(System_state,rng)
+    
+    return System_state,time_step
+
+def first_passage_exit(System_state,rng):
+    
+    # The walker with the earliest exit jumps to the border of its domain
+    first_passage = System_state.first_passage
+    walker = first_passage.next_exit()
+    time_step = walker.exit_time - System_state.time
+    
+    System_state.track_time(time_step)
+    idx = first_passage.exit(walker,System_state)
+    first_passage.protect(idx,System_state,rng)
+
     return System_state,time_step
\ No newline at end of file
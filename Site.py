@@ -6,7 +6,6 @@ Created on Mon Jan 15 11:46:12 2024
 """
 from scipy import constants
 import numpy as np
-from sklearn.decomposition import PCA
 import os
 
 
@@ -25,6 +24,7 @@ class Site():
         # Cache memory            
         self.cache_planes = {}
         self.cache_TR = {}
+        self.cache_T = None # Temperature of cache_TR
         self.cache_edges = {}
         self.cache_clustering_energy = {}
 # =============================================================================
@@ -384,7 +384,8 @@ class Site():
             return
         
         elif len(atom_coordinates) > 2:
-            # Perform PCA
+            # Perform PCA - sklearn is only imported on a cache miss (slow import)
+            from sklearn.decomposition import PCA
             pca = PCA(n_components=3)
             pca.fit(atom_coordinates)
             
@@ -421,7 +422,7 @@ class Site():
         cache_key = self.supp_by
         
         if cache_key in self.cache_edges:
-            self.cache_edges[cache_key]
+            self.edges_v = self.cache_edges[cache_key]
             return 
         
         self.edges_v = {i:None for i in self.mig_paths_plane.keys()}
@@ -464,6 +465,11 @@ class Site():
         kb = constants.physical_constants['Boltzmann constant in eV/K'][0]
         nu0=7E12;  # nu0 (s^-1) bond vibration frequency
         
+        # The cached rates are only valid for one temperature (temperature schedules)
+        if getattr(self,'cache_T',None) != T:
+            self.cache_TR = {}
+            self.cache_T = T
+        
         # Iterate over site_events directly, no need to use range(len(...))
         for event in self.site_events:
             if event[-1] in self.cache_TR:
@@ -490,14 +496,11 @@ class Island:
     def layers_calculation(self,System_state):
         
         grid_crystal = System_state.grid_crystal
-        z_step = System_state.basis_vectors[0][2]
-        z_steps = int(System_state.crystal_size[2]/z_step + 1)
-        layers = [0] * z_steps  # Initialize each layer separately
+        layers = [0] * System_state.z_steps  # Initialize each layer separately
         
         for idx in self.island_sites:
-            site = grid_crystal[idx]
-            z_idx = int(round(site.position[2] / z_step))
-            layers[z_idx] += 1 if site.chemical_specie != 'Empty' else 0
+            if grid_crystal[idx].chemical_specie != 'Empty':
+                layers[System_state.layer_index(idx)] += 1
         
         self.layers = layers
         
@@ -505,10 +508,7 @@ class Island:
     
     def island_terrace(self,System_state):
         
-        grid_crystal = System_state.grid_crystal
-        z_step = System_state.basis_vectors[0][2]
-        z_steps = int(System_state.crystal_size[2]/z_step + 1)
-        sites_per_layer = len(grid_crystal)/z_steps
+        sites_per_layer = System_state.sites_per_layer
 
         area_per_site = System_state.crystal_size[0] * System_state.crystal_size[1] / sites_per_layer
         
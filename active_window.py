@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+Active window: release of the buried layers of thick films after the build
+"""
+import numpy as np
+
+
+# =============================================================================
+# Active window - Thick films (10+ nm)
+#     - depth (active_window_depth): layers kept below the lowest column of the
+#       surface. 0: the window is inactive and every layer is simulated
+#     - The layers more than `depth` layers below the lowest (x,y) column of the
+#       surface are frozen: their particles are buried and they will not move again
+#     - Frozen layers are compacted: the occupancy of each layer is stored as a packed
+#       bitmap (np.packbits) with the sites in the same order, and the Site objects
+#       are removed from grid_crystal, sites_occupied, the island tracker and the
+#       surface height map. thickness, mass and fraction of sites occupied include
+#       the particles of the compacted layers
+#     - The lowest materialized layer (frozen_layer) is the seal of the window: its
+#       sites are kept (supports and clustering energies of the layer above), but
+#       they lose the neighbors in the compacted layers and their events are not
+#       calculated again (update_sites). The particles of the layer above cannot
+#       migrate down to the vacancies of the seal
+#     - The window moves up with the growth front: update() is called with the
+#       measurements, so the sites of the simulation are the ones of the top layers
+#
+# The window does not reduce the peak memory: grid_crystal is built for the whole
+# crystal_size (and the lattice templates) before the simulation, and the window
+# only releases the Site objects of the deep layers as the film grows. The memory
+# of the bookkeeping (events, indexes, islands, surface) and the time of the KMC
+# steps do not grow with the buried film
+# =============================================================================
+
+class Active_Window():
+
+    def __init__(self,depth = 0):
+
+        self.depth = depth # Layers (layer_index) below the lowest column of the surface kept active (0: inactive)
+        self.frozen_layer = -1 # Layers <= frozen_layer are frozen, layers < frozen_layer are compacted
+        self.layer_sites = None # Layer -> sites of the layers that are not compacted
+        self.bitmaps = [] # Packed occupancy of each compacted layer
+        self.compacted_sites = [] # Sites of each compacted layer (same order as the bitmap)
+        self.n_sites = 0 # Sites in the compacted layers
+        self.n_occupied = 0 # Particles in the compacted layers
+
+    @property
+    def active(self):
+        return self.depth > 0
+
+    def update(self,System_state):
+
+        if not self.active or np.all(np.isnan(System_state.surface_height)): return
+
+        # Surface points are z + z_step: the lowest column has its highest particle at lowest_level - 1
+        lowest_level = int(round(np.nanmin(System_state.surface_height) / System_state.z_step))
+        frozen_layer = lowest_level - self.depth - 1
+        if frozen_layer <= self.frozen_layer: return
+
+        if self.layer_sites is None:
+            self.layer_sites = {}
+            for idx in System_state.grid_crystal:
+                self.layer_sites.setdefault(System_state.layer_index(idx),[]).append(idx)
+            for sites in self.layer_sites.values():
+                sites.sort()
+
+        # z_step can be smaller than the distance between layers: not every z_idx is a layer
+        layers = sorted(z_idx for z_idx in self.layer_sites if z_idx <= frozen_layer)
+        if not layers or layers[-1] <= self.frozen_layer: return
+
+        for z_idx in layers:
+            if z_idx > self.frozen_layer:
+                self.freeze_layer(z_idx,System_state)
+        for z_idx in layers[:-1]:
+            self.compact_layer(z_idx,System_state)
+        self.seal_layer(layers[-1],System_state)
+
+        self.frozen_layer = layers[-1]
+        # The arrays of grid_crystal are built again (peak_detection)
+        for key in ('site_list','site_index','positions','neighbor_graph'):
+            System_state.__dict__.pop(key,None)
+
+    def frozen(self,idx,System_state):
+        return self.frozen_layer >= 0 and System_state.layer_index(idx) <= self.frozen_layer
+
+# =============================================================================
+#     Freeze: no events, superbasins or first-passage walkers
+# =============================================================================
+    def freeze_layer(self,z_idx,System_state):
+
+        first_passage = System_state.first_passage
+
+        for idx in self.layer_sites[z_idx]:
+            System_state.grid_crystal[idx].site_events = []
+            System_state.energy_index.remove(idx)
+            System_state.active_sites.discard(idx)
+            System_state.adsorption_sites.discard(idx)
+
+            particles = set(System_state.superbasin_index.get(idx,()))
+            if idx in System_state.superbasin_dict: particles.add(idx)
+            for particle in particles:
+                System_state.remove_superbasin(particle)
+
+            walker = first_passage.walkers.get(idx,first_passage.domain_index.get(idx))
+            if walker is not None:
+                first_passage.release(walker)
+
+# =============================================================================
+#     Compact: occupancy bitmap and the Site objects are removed
+# =============================================================================
+    def compact_layer(self,z_idx,System_state):
+
+        grid_crystal = System_state.grid_crystal
+        island_tracker = System_state.island_tracker
+        sites = self.layer_sites.pop(z_idx)
+
+        occupancy = np.array([grid_crystal[idx].chemical_specie != 'Empty' for idx in sites],dtype = bool)
+        self.bitmaps.append(np.packbits(occupancy))
+        self.compacted_sites.append(np.array(sites,dtype = np.int32))
+        self.n_sites += len(sites)
+        self.n_occupied += int(occupancy.sum())
+
+        for idx in sites:
+            System_state.sites_occupied.discard(idx)
+            System_state.active_sites.discard(idx)
+            System_state.energy_index.remove(idx)
+            System_state.adsorption_sites.discard(idx)
+            island_tracker.release_site(idx)
+            System_state.site_column.pop(idx,None)
+            System_state.site_surface_level.pop(idx,None)
+            System_state.surface_dependents.pop(idx,None)
+            del grid_crystal[idx]
+
+    def seal_layer(self,z_idx,System_state):
+
+        grid_crystal = System_state.grid_crystal
+        island_tracker = System_state.island_tracker
+
+        for idx in self.layer_sites[z_idx]:
+            site = grid_crystal[idx]
+            neighbors = [(neighbor,pos) for neighbor,pos in zip(site.nearest_neighbors_idx,site.nearest_neighbors_cart)
+                         if neighbor in grid_crystal]
+            site.nearest_neighbors_idx = [neighbor for neighbor,pos in neighbors]
+            site.nearest_neighbors_cart = [pos for neighbor,pos in neighbors]
+            site.migration_paths['Down'] = [path for path in site.migration_paths['Down'] if path[0] in grid_crystal]
+            # energy_site is not calculated again: it still counts the compacted neighbors
+            site.supp_by = tuple(idx_site for idx_site in site.supp_by if idx_site in ('bottom_layer','top_layer') or idx_site in grid_crystal)
+            island_tracker.neighbors[idx] = [neighbor for neighbor in island_tracker.neighbors[idx] if neighbor in grid_crystal]
+            System_state.surface_dependents[idx] = [site_idx for site_idx in System_state.surface_dependents[idx] if site_idx in grid_crystal]
+
+        # The vacancies of the seal are not destinations: a particle there would not have events again
+        above = min((layer for layer in self.layer_sites if layer > z_idx),default = None)
+        if above is None: return
+        seal = set(self.layer_sites[z_idx])
+        update_specie_events = set()
+        for idx in self.layer_sites[above]:
+            site = grid_crystal[idx]
+            site.migration_paths['Down'] = [path for path in site.migration_paths['Down'] if path[0] not in seal]
+            if site.chemical_specie != 'Empty':
+                update_specie_events.add(idx)
+        System_state.update_sites(update_specie_events,set())
+
+# =============================================================================
+#     Compacted layers
+# =============================================================================
+    def occupancy(self,i):
+
+        # Sites and occupancy of the compacted layer i
+        sites = self.compacted_sites[i]
+        return sites,np.unpackbits(self.bitmaps[i],count = len(sites)).astype(bool)
+
+    def occupied_sites(self):
+
+        sites = [self.occupancy(i) for i in range(len(self.bitmaps))]
+        return [tuple(idx) for layer_sites,occupancy in sites for idx in layer_sites[occupancy]]
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Correctness benchmark: hybrid tau-leaping against exact KMC
+"""
+from initialization import initialization
+from KMC import KMC
+import numpy as np
+import copy
+import time
+import matplotlib.pyplot as plt
+
+
+# =============================================================================
+# Correctness benchmark - Hybrid tau-leaping vs exact KMC
+#     - Both engines start from the same System_state (deepcopy) and run n_runs
+#       simulations each with different seeds until total_time
+#     - Thickness and RMS roughness are measured at the same times
+#     - We compare the mean curves: difference in units of the standard error
+#       (|z| < 3 at every time: the curves are statistically equivalent)
+#
+# The deposition conditions are the ones in initialization() (e.g. 113 Pa)
+# =============================================================================
+
+def run_simulation(System_state,rng,time_points):
+
+    thickness = []
+    roughness = []
+    start_time = time.time()
+
+    for t in time_points:
+        while System_state.time < t:
+            System_state,KMC_time_step = KMC(System_state,rng)
+        System_state.measurements_crystal()
+        thickness.append(System_state.thickness)
+        roughness.append(System_state.surf_roughness_RMS)
+
+    return np.array(thickness),np.array(roughness),System_state.kmc_steps,time.time() - start_time
+
+def compare(curves_exact,curves_leaping):
+
+    # Difference of the means in units of the standard error
+    mean_exact,mean_leaping = curves_exact.mean(axis = 0),curves_leaping.mean(axis = 0)
+    std_error = np.sqrt(curves_exact.var(axis = 0,ddof = 1) / len(curves_exact)
+                        + curves_leaping.var(axis = 0,ddof = 1) / len(curves_leaping))
+    z = np.abs(mean_exact - mean_leaping) / np.where(std_error > 0,std_error,np.inf)
+    return mean_exact,mean_leaping,z
+
+save_data = False
+lammps_file = False
+n_runs = 10
+n_points = 20
+tau_leaping = 0.03 # Fraction of adsorption sites filled per leap
+
+System_state_0,rng,paths,Results = initialization(0,save_data,lammps_file)
+System_state_0.superbasin_telemetry.verbose = False
+
+# ~4 monolayers: each adsorption site is filled with rate TR_gen
+total_time = 4 / System_state_0.TR_gen
+time_points = np.linspace(total_time / n_points,total_time,n_points)
+
+results = {}
+for engine,tau in (('Exact KMC',0),('Tau-leaping',tau_leaping)):
+
+    thickness,roughness,kmc_steps,wall_time = [],[],[],[]
+    for n_run in range(n_runs):
+        System_state = copy.deepcopy(System_state_0)
+        System_state.tau_leaping = tau
+        run = run_simulation(System_state,np.random.default_rng(n_run),time_points)
+        thickness.append(run[0])
+        roughness.append(run[1])
+        kmc_steps.append(run[2])
+        wall_time.append(run[3])
+
+    results[engine] = (np.array(thickness),np.array(roughness))
+    print(f"{engine} | KMC steps: {np.mean(kmc_steps):.0f} | Wall time: {np.mean(wall_time):.1f} s")
+
+fig, axes = plt.subplots(1,2,figsize = (10,4))
+for ax,i,label in zip(axes,(0,1),('Thickness (Å)','RMS roughness (Å)')):
+    mean_exact,mean_leaping,z = compare(results['Exact KMC'][i],results['Tau-leaping'][i])
+    print(f"{label} | Max |z|: {z.max():.2f} | Max relative difference: "
+          f"{np.max(np.abs(mean_leaping - mean_exact) / np.maximum(np.abs(mean_exact),1e-12)):.3g}")
+
+    for engine,mean in (('Exact KMC',mean_exact),('Tau-leaping',mean_leaping)):
+        ax.errorbar(time_points,mean,yerr = results[engine][i].std(axis = 0,ddof = 1),label = engine,capsize = 2)
+    ax.set_xlabel('Time (s)')
+    ax.set_ylabel(label)
+    ax.legend()
+
+plt.tight_layout()
+plt.show()
@@ -5,24 +5,28 @@ Created on Wed Jan 10 15:19:06 2024
 @author: samuel.delgado
 """
 # import lattpy as lp # https://lattpy.readthedocs.io/en/latest/tutorial/finite.html#position-and-neighbor-data
-import matplotlib.pyplot as plt
 from Site import Site,Island
+from lattice_template import Lattice_Template,load_template,reduced_supercell
+from indexed_set import Indexed_Set
+from island_tracker import Island_Tracker
+from superbasin import Superbasin_Cache
+from energy_index import Energy_Index
+from superbasin_scheduler import Superbasin_Scheduler
+from superbasin_telemetry import Superbasin_Telemetry
+from flicker_detector import Flicker_Detector
+from rate_rescaling import Rate_Rescaling
+from first_passage import First_Passage
+from active_window import Active_Window
+from temperature_schedule import Temperature_Schedule
 from scipy import constants
 import numpy as np
 import math
-from matplotlib import cm
 import time
 
-# Pymatgen for creating crystal structure and connect with Crystallography Open Database or Material Project
-# from pymatgen.ext.cod import COD
-from pymatgen.core.operations import SymmOp
-from pymatgen.transformations.advanced_transformations import CubicSupercellTransformation
-from pymatgen.ext.matproj import MPRester
-from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
-from pymatgen.analysis.wulff import WulffShape
-from pymatgen.core.periodic_table import Element
-from pymatgen.analysis.defects.generators import ChargeInterstitialGenerator
-from pymatgen.core import Structure
+# Plotting (matplotlib) and Pymatgen (crystal structure, Materials Project, Wulff shape 
+# and defect generators) are imported inside the methods that use them.
+# Importing them here takes several seconds, which dominates short headless runs
+# (e.g. lammps_file = True and grid_crystal loaded from file)
 
 
 import json
@@ -37,7 +41,7 @@ from pathlib import Path
 
 class Crystal_Lattice():
     
-    def __init__(self,crystal_features,experimental_conditions,Act_E_list,lammps_file,superbasin_parameters,grid_crystal = None):
+    def __init__(self,crystal_features,experimental_conditions,Act_E_list,lammps_file,superbasin_parameters,grid_crystal = None,template_path = None):
         
         # Crystal features
         self.id_material = crystal_features[0]
@@ -50,12 +54,16 @@ class Crystal_Lattice():
         interstitial = crystal_features[7]
         radius_neighbors = crystal_features[8]
         self.sites_generation_layer = crystal_features[9]
+        # Moving active window: layers below this depth under the lowest surface column are compacted (0: whole domain)
+        self.active_window = Active_Window(crystal_features[10] if len(crystal_features) > 10 else 0)
         
         # Deposition
         self.sticking_coefficient = experimental_conditions[0]
         self.partial_pressure = experimental_conditions[1]
         self.temperature = experimental_conditions[2]
         self.experiment = experimental_conditions[3]
+        # Ramps and holds of temperature (annealing) - Inactive: constant temperature
+        self.temperature_schedule = Temperature_Schedule()
         # Activation energies
         self.activation_energies = Act_E_list
         
@@ -64,17 +72,48 @@ class Crystal_Lattice():
         self.time_step_limits = superbasin_parameters[1]
         self.E_min = superbasin_parameters[2]
         self.energy_step = superbasin_parameters[3]
+        # Wall-clock budget for each search of superbasins (s)
+        superbasin_time_budget = superbasin_parameters[4] if len(superbasin_parameters) > 4 else 300
         self.superbasin_dict = {}
+        self.superbasin_index = {} # Site -> particles with a superbasin whose environment contains the site
+        self.superbasin_cache = Superbasin_Cache() # Solved superbasins by local configuration
+        # Occupied sites by their lowest activation energy - Candidates for superbasins
+        self.energy_index = Energy_Index(self.energy_step if self.energy_step > 0 else 0.05)
+        # Priority and deadline of the superbasin search, and speedup of each superbasin
+        self.superbasin_scheduler = Superbasin_Scheduler(superbasin_time_budget)
+        # Sizes, times, condition numbers and lifetime of the superbasins
+        self.superbasin_telemetry = Superbasin_Telemetry()
+        # Recent events - Particles moving back and forth trigger the superbasin search
+        self.flicker_detector = Flicker_Detector(self.n_search_superbasin)
+        # AS-KMC: scale down the rates of quasi-equilibrated processes instead of building superbasins
+        self.rate_rescaling = Rate_Rescaling(superbasin_parameters[5] if len(superbasin_parameters) > 5 else False)
+        # First-passage moves for isolated adatoms on flat terraces
+        self.first_passage = First_Passage(superbasin_parameters[6] if len(superbasin_parameters) > 6 else False)
+        # Hybrid tau-leaping for the adsorption: maximum fraction of adsorption sites filled per leap (0: exact KMC)
+        self.tau_leaping = superbasin_parameters[7] if len(superbasin_parameters) > 7 else 0
 
         self.time = 0
+        self.kmc_steps = 0
         self.list_time = []
         
+        # Lattice templates (topology in reduced coordinates) are stored in template_path
+        self.template_path = template_path
+        self.lattice_from_template = False
+        
         # Crystal_grid generation
         self.lattice_model(interstitial_specie,api_key,radius_neighbors,interstitial)
         self.crystal_grid(grid_crystal,radius_neighbors,use_parallel)
 
-        self.sites_occupied = [] # Sites occupy be a chemical specie
-        self.adsorption_sites = [] # Sites availables for deposition or migration
+        # Indexed sets: add/remove/membership in O(1)
+        self.sites_occupied = Indexed_Set() # Sites occupy be a chemical specie
+        self.active_sites = Indexed_Set() # Sites occupied that are not inert (see update_active_site)
+        self.adsorption_sites = Indexed_Set() # Sites availables for deposition or migration
+        # Number of sites occupied per layer - Updated when introducing/removing species
+        self.layers_occupancy()
+        # Height of the surface for each (x,y) column - Updated when introducing/removing species
+        self.surface_height_map()
+        # Islands: groups of connected particles - Updated when introducing/removing species
+        self.island_tracker = Island_Tracker(self.grid_crystal)
         
         #Transition rate for adsortion of chemical species
         if self.experiment != 'ECM memristor':
@@ -93,6 +132,11 @@ class Crystal_Lattice():
             nu0=7E12;  # nu0 (s^-1) bond vibration frequency
             T = 300
             self.TR_gen = nu0 * np.exp(-self.Act_E_gen / (kb * T))
+            
+        # Save the topology of the lattice we have just built so other materials 
+        # with the same structure type, orientation and supercell can reuse it
+        if self.template_path is not None and self.structure_type is not None and not self.lattice_from_template and grid_crystal is None:
+            Lattice_Template(self,self.structure_type,self.lattice_constants[0] * 10,radius_neighbors).save(self.template_path)
 
         
         # Obtain all the positions in the grid that are supported by the
@@ -106,12 +150,21 @@ class Crystal_Lattice():
 
     
     def lattice_model(self,interstitial_specie,api_key,radius_neighbors,interstitial = False):
+        
+        # Pymatgen for creating crystal structure and connect with Crystallography Open Database or Material Project
+        # from pymatgen.ext.cod import COD
+        from pymatgen.core.operations import SymmOp
+        from pymatgen.transformations.advanced_transformations import CubicSupercellTransformation
+        from pymatgen.ext.matproj import MPRester
+        from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
+        from pymatgen.core import Structure
 
         with MPRester(api_key) as mpr:
             structure = mpr.get_structure_by_material_id(self.id_material)
             
             # If we want to include interstitial sites
             if interstitial:
+                from pymatgen.analysis.defects.generators import ChargeInterstitialGenerator
                 chgcar = mpr.get_charge_density_from_material_id(self.id_material) #Download charge density from MP
                 cig = ChargeInterstitialGenerator() # Defect generator based on charge density
                 defects = cig.generate(chgcar, insert_species=[interstitial_specie]) # Generate interstitial specie
@@ -143,12 +196,15 @@ class Crystal_Lattice():
             sga = SpacegroupAnalyzer(structure)
             self.structure_basic = sga.get_conventional_standard_structure()
             self.chemical_specie = self.structure_basic.composition.reduced_formula
+            # Structure type to identify the lattice templates (225 for fcc)
+            self.structure_type = f"sg{sga.get_space_group_number()}"
 
         # If we are interested in the interstitial sites (interstitial == True)
         else:
             sga = SpacegroupAnalyzer(structure_with_interstitial)
             self.structure_basic = sga.get_conventional_standard_structure()
             self.chemical_specie = interstitial_specie
+            self.structure_type = None # No lattice templates for interstitial sites
             
         self.lattice_constants = tuple(np.array(self.structure_basic.lattice.abc)/10)
 
@@ -190,6 +246,23 @@ class Crystal_Lattice():
         # Events corresponding to migrations + superbasin migration (+1) + deposition (+1)
         self.num_event = len(self.structure.get_neighbors(self.structure[0],radius_neighbors)) + 2
         
+        # Search a lattice template with the same structure type, orientation, supercell and radius of the neighbors
+        # We only need to scale it with the lattice constant of this material
+        if grid_crystal == None and self.template_path is not None and self.structure_type is not None:
+            lattice_constant = self.lattice_constants[0] * 10 # (Angstrom)
+            lattice_template = load_template(self.template_path,self.structure_type,self.latt_orientation,
+                                             reduced_supercell(self.crystal_size,lattice_constant),radius_neighbors)
+            
+            # The same radius can include a different number of neighbors for other lattice constant
+            if lattice_template is not None and lattice_template.num_event == self.num_event:
+                self.lattice_from_template = True
+                self.coord_cache = {}
+                self.event_labels = lattice_template.event_labels
+                self.num_event = lattice_template.num_event
+                self.domain_height = lattice_template.domain_height * lattice_constant
+                self.grid_crystal = lattice_template.build_grid_crystal(lattice_constant,self.activation_energies)
+                return
+        
         if grid_crystal == None:
             # Set default parallelization based on system size and cores
             if use_parallel is None:
@@ -295,6 +368,62 @@ class Crystal_Lattice():
             for site in self.grid_crystal.values():
                 site.Act_E_list = self.activation_energies
 
+    def __setstate__(self,state):
+        
+        # Crystal_Lattice saved before tracking the layer occupancy: thickness, layers and 
+        # terraces were attributes and now are calculated from the occupancy per layer
+        for key in ('thickness','layers','terraces'):
+            state.pop(key,None)
+        self.__dict__.update(state)
+        
+        # Not the case when it is copied to other processes while creating grid_crystal
+        if 'sites_occupied' in state:
+            if 'occupancy_layers' not in state:
+                self.layers_occupancy()
+            if 'surface_height' not in state:
+                self.surface_height_map()
+            elif 'surface_dependents' not in state:
+                self.surface_dependents_map()
+            if 'island_tracker' not in state:
+                self.island_tracker = Island_Tracker(self.grid_crystal)
+                for idx in self.sites_occupied:
+                    self.island_tracker.add_site(idx,self.layer_index(idx))
+            if 'superbasin_telemetry' not in state:
+                self.superbasin_telemetry = Superbasin_Telemetry()
+            if 'flicker_detector' not in state:
+                self.flicker_detector = Flicker_Detector(self.n_search_superbasin)
+            if 'rate_rescaling' not in state:
+                self.rate_rescaling = Rate_Rescaling()
+            if 'first_passage' not in state:
+                self.first_passage = First_Passage()
+            if 'tau_leaping' not in state:
+                self.tau_leaping = 0
+            if 'superbasin_scheduler' not in state:
+                self.superbasin_scheduler = Superbasin_Scheduler()
+                self.kmc_steps = 0
+                for superbasin in self.superbasin_dict.values():
+                    self.superbasin_scheduler.superbasin_created(superbasin,self)
+            if 'superbasin_index' not in state:
+                superbasin_dict = self.superbasin_dict
+                self.superbasin_dict = {}
+                self.superbasin_index = {}
+                for idx,superbasin in superbasin_dict.items():
+                    self.add_superbasin(idx,superbasin)
+            if 'superbasin_cache' not in state:
+                self.superbasin_cache = Superbasin_Cache()
+            if 'energy_index' not in state:
+                self.energy_index = Energy_Index(self.energy_step if self.energy_step > 0 else 0.05)
+                for idx in self.sites_occupied:
+                    self.energy_index.update(idx,self.grid_crystal[idx].site_events)
+            if 'active_sites' not in state:
+                self.active_sites = Indexed_Set()
+                for idx in self.sites_occupied:
+                    self.update_active_site(idx)
+            if 'active_window' not in state:
+                self.active_window = Active_Window()
+            if 'temperature_schedule' not in state:
+                self.temperature_schedule = Temperature_Schedule()
+            
     def get_num_cores(self):
         cores_from_env = (os.environ.get('SLURM_CPUS_PER_TASK') or 
             os.environ.get('PBS_NP'))        
@@ -338,6 +467,9 @@ class Crystal_Lattice():
 
     def Wulff_Shape(self,api_key):
         
+        from pymatgen.ext.matproj import MPRester
+        from pymatgen.analysis.wulff import WulffShape
+        
         with MPRester(api_key=api_key) as mpr:
             surface_properties_doc = mpr.materials.surface_properties.search(
                 material_ids=self.id_material
@@ -450,24 +582,23 @@ class Crystal_Lattice():
         
         
         if not update_supp_av:
-            self.adsorption_sites = [
+            self.adsorption_sites = Indexed_Set(
                 idx for idx, site in self.grid_crystal.items()
                 if (sites_generation_layer in site.supp_by or len(site.supp_by) > 2) and site.chemical_specie == 'Empty'
-                ]
+                )
                     
                     
         else:
-            adsorption_sites_set = set(self.adsorption_sites)
             for idx in update_supp_av:
                 site = self.grid_crystal[idx]
-                if idx in adsorption_sites_set:
+                if idx in self.adsorption_sites:
                     if ((sites_generation_layer not in site.supp_by and len(site.supp_by) < 3) or (site.chemical_specie != 'Empty')):
                         self.adsorption_sites.remove(idx)
                         site.remove_event_type(self.num_event-1)
                     
                 else:
                     if (sites_generation_layer in site.supp_by or len(site.supp_by) > 2) and site.chemical_specie == 'Empty':
-                        self.adsorption_sites.append(idx)
+                        self.adsorption_sites.add(idx)
                         site.deposition_event(self.TR_gen,idx,self.num_event-1,self.Act_E_gen)
         
                     
@@ -480,6 +611,7 @@ class Crystal_Lattice():
         
         # Maxwell-Boltzman statistics for transition rate of adsorption rate
         sticking_coeff, partial_pressure, T = experimental_conditions
+        from pymatgen.core.periodic_table import Element
         self.mass_specie = Element(self.chemical_specie).atomic_mass
 
         # The mass in kg of a unit of the chemical specie
@@ -504,12 +636,53 @@ class Crystal_Lattice():
         nu0=7E12;  # nu0 (s^-1) bond vibration frequency
         self.Act_E_gen = -np.log(self.TR_gen/nu0) * kb * self.temperature
         
+# =============================================================================
+#     Change of temperature (temperature_schedule)
+#     - The activation energies do not depend on the temperature, so the events are
+#       not calculated again (available_migrations). The rate of each energy class is
+#       calculated at once and assigned to the events of that class
+#     - Deposition (TR_gen) does not depend on the temperature of the substrate
+#     - The superbasins are dismantled (their rates come from the absorbing Markov
+#       chain at the previous temperature) and the AS-KMC scaling starts again
+# =============================================================================
+    def set_temperature(self,T):
+        
+        if T == self.temperature: return
+        self.temperature = T
+        
+        kb = constants.physical_constants['Boltzmann constant in eV/K'][0]
+        nu0=7E12;  # nu0 (s^-1) bond vibration frequency
+        deposition_event = self.num_event - 1
+        
+        # Sites with events: active_sites (inert sites have no events)
+        events = [event for idx in self.active_sites for event in self.grid_crystal[idx].site_events
+                  if event[2] != deposition_event]
+        if events:
+            energy_classes, event_class = np.unique([event[3] for event in events], return_inverse = True)
+            TR_classes = nu0 * np.exp(-energy_classes / (kb * T))
+            for event,TR in zip(events,TR_classes[event_class].tolist()):
+                event[0] = TR
+            
+        for idx in list(self.superbasin_dict):
+            self.remove_superbasin(idx)
+        self.rate_rescaling.reset()
+        
     def limit_kmc_timestep(self,P_limits):
         
         self.timestep_limits = -np.log(1-P_limits)/self.TR_gen
         
     
 
+    def deposition_sites(self,sites):
+        
+        # Introduce a particle in each site and update the sites once
+        update_supp_av = set()
+        update_specie_events = set()
+        for idx in sites:
+            update_specie_events,update_supp_av = self.introduce_specie_site(idx,update_specie_events,update_supp_av)
+            
+        self.update_sites(update_specie_events,update_supp_av)
+        
     def deposition_specie(self,t,rng,test = 0):  
 
         update_supp_av = set()
@@ -519,8 +692,9 @@ class Crystal_Lattice():
             
             P = 1-np.exp(-self.TR_gen*t) # Adsorption probability in time t
             # Indexes of sites availables: supported by substrates or other species
-            for idx in self.adsorption_sites:
-                if rng.random() < P:   
+            # One random number per site, drawn at once
+            for idx,r in zip(list(self.adsorption_sites),rng.random(len(self.adsorption_sites))):
+                if r < P:   
                     # Introduce specie in the site
                     update_specie_events,update_supp_av = self.introduce_specie_site(idx,update_specie_events,update_supp_av)
             
@@ -749,7 +923,8 @@ class Crystal_Lattice():
 # =============================================================================
 #         Specie migration
 # =============================================================================
-        if chosen_event[2] <= (self.num_event - 2): # 12 migration possibilities [0-11] and [12] for migrating from superbasin
+        # 12 migration possibilities [0-11], [12] for migrating from superbasin and [14] for first-passage moves
+        if chosen_event[2] <= (self.num_event - 2) or chosen_event[2] == self.num_event:
             
             # Introduce specie in the site
             update_specie_events,update_supp_av = self.introduce_specie_site(chosen_event[1],update_specie_events,update_supp_av)
@@ -777,15 +952,41 @@ class Crystal_Lattice():
             
         # We dismantle the superbasin if the chosen_event affect some of the states
         # that belong to any of the superbasin
-        keys_to_delete = [idx for idx, sb in self.superbasin_dict.items()
-                          if chosen_event[1] in sb.superbasin_environment or
-                          chosen_event[-1] in sb.superbasin_environment]
+        # superbasin_index: only the superbasins that contain the origin or the destination
+        keys_to_delete = (self.superbasin_index.get(chosen_event[1],set()) 
+                          | self.superbasin_index.get(chosen_event[-1],set()))
 
         for key in keys_to_delete:
-            del self.superbasin_dict[key]
+            self.remove_superbasin(key)
+            
+        # Particles that flicker - Trigger and priority of the next superbasin search
+        self.flicker_detector.record_event(chosen_event)
+            
+    def add_superbasin(self,idx,superbasin):
+        
+        if idx in self.superbasin_dict:
+            self.remove_superbasin(idx)
+        
+        self.superbasin_dict[idx] = superbasin
+        for site in superbasin.superbasin_environment:
+            self.superbasin_index.setdefault(site,set()).add(idx)
+        self.superbasin_scheduler.superbasin_created(superbasin,self)
             
+    def remove_superbasin(self,idx):
+        
+        superbasin = self.superbasin_dict.pop(idx)
+        for site in superbasin.superbasin_environment:
+            self.superbasin_index[site].discard(idx)
+            if not self.superbasin_index[site]:
+                del self.superbasin_index[site]
+        self.superbasin_scheduler.superbasin_dismantled(superbasin,self)
     
     def update_sites(self,update_specie_events,update_supp_av):
+        
+        # Frozen layers keep their supports and have no events (active_window)
+        if self.active_window.frozen_layer >= 0:
+            update_supp_av = {idx for idx in update_supp_av if not self.active_window.frozen(idx,self)}
+            update_specie_events = {idx for idx in update_specie_events if not self.active_window.frozen(idx,self)}
             
         if update_supp_av:
                 
@@ -801,6 +1002,25 @@ class Crystal_Lattice():
             for idx in update_specie_events:
                 self.grid_crystal[idx].available_migrations(self.grid_crystal,idx,self.facets_type)
                 self.grid_crystal[idx].transition_rates(self.temperature)
+                self.energy_index.update(idx,self.grid_crystal[idx].site_events)
+                self.update_active_site(idx)
+                
+# =============================================================================
+#     Inert sites: occupied, without events and surrounded by occupied sites 
+#     (buried particles). They are not in active_sites, so KMC() does not go over
+#     them. A particle can only migrate to an empty neighbor, so an inert site is
+#     reactivated when one of its neighbors is emptied (remove_specie_site)
+# =============================================================================
+    def update_active_site(self,idx):
+        
+        site = self.grid_crystal[idx]
+        if site.chemical_specie == 'Empty':
+            self.active_sites.discard(idx)
+        elif not site.site_events and all(self.grid_crystal[neighbor].chemical_specie != 'Empty' 
+                                          for neighbor in self.island_tracker.neighbors[idx]):
+            self.active_sites.discard(idx)
+        else:
+            self.active_sites.add(idx)
    
     # def update_sites_2(self,update_specie_events,update_supp_av, batch_size=10):
 
@@ -841,8 +1061,12 @@ class Crystal_Lattice():
         
         # Chemical specie deposited
         self.grid_crystal[idx].introduce_specie(self.chemical_specie)
-        # Track sites occupied
-        self.sites_occupied.append(idx) 
+        # Track sites occupied and occupancy per layer
+        if idx not in self.sites_occupied:
+            self.occupancy_layers[self.layer_index(idx)] += 1
+            self.island_tracker.add_site(idx,self.layer_index(idx))
+        self.sites_occupied.add(idx) 
+        self.update_surface_height(idx)
         # Track sites available
         update_specie_events.add(idx)
         
@@ -878,9 +1102,17 @@ class Crystal_Lattice():
         
         # Chemical specie removed
         self.grid_crystal[idx].remove_specie()
-        # Track sites occupied
-
+        # Track sites occupied and occupancy per layer
         self.sites_occupied.remove(idx) 
+        self.occupancy_layers[self.layer_index(idx)] -= 1
+        self.island_tracker.remove_site(idx)
+        self.energy_index.remove(idx)
+        self.update_surface_height(idx)
+        # Reactivate the inert neighbors - Neighbors in both directions (periodic boundaries)
+        self.active_sites.discard(idx)
+        for neighbor in self.island_tracker.neighbors[idx]:
+            if self.grid_crystal[neighbor].chemical_specie != 'Empty' and not self.active_window.frozen(neighbor,self):
+                self.active_sites.add(neighbor)
    
         # Track sites available
         update_specie_events.discard(idx)
@@ -912,6 +1144,7 @@ class Crystal_Lattice():
     def track_time(self,t):
         
         self.time += t
+        self.kmc_steps += 1
         
     def add_time(self):
         
@@ -925,6 +1158,7 @@ class Crystal_Lattice():
 
     def plot_lattice_points(self,azim = 60,elev = 45):
         
+        import matplotlib.pyplot as plt
         fig = plt.figure()
         ax = fig.add_subplot(111, projection='3d')
         
@@ -947,6 +1181,7 @@ class Crystal_Lattice():
     def plot_crystal(self,azim = 60,elev = 45,path = '',i = 0):
         
         if self.lammps_file == False:
+            import matplotlib.pyplot as plt
             nr = 1
             nc = 2
             fig = plt.figure(constrained_layout=True,figsize=(15, 8),dpi=300)
@@ -1029,6 +1264,10 @@ class Crystal_Lattice():
                                              'Material id (Materials Project)':self.id_material,
                                              'Search superbasin after n steps with small time steps': self.n_search_superbasin,
                                              'Time limitation to search superbasin': self.time_step_limits,
+                                             'Wall-clock budget for each superbasin search (s)': self.superbasin_scheduler.time_budget,
+                                             'Rate rescaling (AS-KMC) instead of superbasins': self.rate_rescaling.active,
+                                             'First-passage moves for isolated adatoms': self.first_passage.active,
+                                             'Tau-leaping for adsorption (fraction of sites per leap)': self.tau_leaping,
                                              'Minimum activation energy for building superbasins':self.E_min,
                                              'Activation energy set':self.activation_energies}
                 with open(metadata_path, 'w') as metadata_file:
@@ -1042,6 +1281,8 @@ class Crystal_Lattice():
         
     def plot_crystal_surface(self):
         
+        import matplotlib.pyplot as plt
+        from matplotlib import cm
         x,y,z = self.obtain_surface_coord()
                 
         
@@ -1075,14 +1316,12 @@ class Crystal_Lattice():
         
         self.calculate_mass()
         self.sites_occupation()
-        self.average_thickness()
-        self.terrace_area()
         self.RMS_roughness()
         
     def calculate_mass(self):
         
         x_size, y_size = self.crystal_size[:2]
-        density = len(self.sites_occupied) * self.mass_specie / (x_size * y_size)
+        density = (len(self.sites_occupied) + self.active_window.n_occupied) * self.mass_specie / (x_size * y_size)
         g_to_ng = 1e9
         nm_to_cm = 1e7
         
@@ -1091,52 +1330,60 @@ class Crystal_Lattice():
 # =============================================================================
 # We calculate % occupy per layer
 # Average the contribution of each layer to the thickness acording to the z step
+#     - occupancy_layers is updated in introduce_specie_site() and remove_specie_site(),
+#       so thickness, layers and terraces are always up to date
 # =============================================================================
-    def average_thickness(self):
+    def layers_occupancy(self):
         
-        grid_crystal = self.grid_crystal
-        z_step = next((vec[2] for vec in self.basis_vectors if vec[2] > 0), None)
-        z_steps = round(self.crystal_size[2]/z_step + 1)
-        layers = [0] * z_steps  # Initialize each layer separately
-
-        for site in grid_crystal.values():
-            z_idx = int(round(site.position[2] / z_step))
-            layers[z_idx] += 1 if site.chemical_specie != 'Empty' else 0
-
-        sites_per_layer = len(grid_crystal)/z_steps
-        normalized_layers = [count / sites_per_layer for count in layers]
-        # Number of sites occupied and percentage of occupation for each layer
-        self.layers = [layers, normalized_layers]
+        # Round-off of the rotation can leave z components ~1e-16 in the basis vectors
+        tol = 1e-6
+        self.z_step = next((vec[2] for vec in self.basis_vectors if vec[2] > tol), None)
+        self.z_steps = round(self.crystal_size[2]/self.z_step + 1)
+        self.sites_per_layer = len(self.grid_crystal)/self.z_steps
         
+        self.occupancy_layers = [0] * self.z_steps  # Initialize each layer separately
+        for idx in self.sites_occupied:
+            self.occupancy_layers[self.layer_index(idx)] += 1
+            
+    def layer_index(self,idx):
+        return int(round(self.grid_crystal[idx].position[2] / self.z_step))
+    
+    @property
+    def thickness(self):
         # Layer 0 is z = 0, so it doesn't contribute
-        self.thickness = sum(normalized_layers) * z_step # (nm)    
-        
-    def sites_occupation(self):
-        
-        self.fraction_sites_occupied = len(self.sites_occupied) / len(self.grid_crystal) 
+        return (len(self.sites_occupied) + self.active_window.n_occupied) / self.sites_per_layer * self.z_step # (nm)
+    
+    @property
+    def layers(self):
+        # Number of sites occupied and percentage of occupation for each layer
+        normalized_layers = [count / self.sites_per_layer for count in self.occupancy_layers]
+        return [self.occupancy_layers.copy(), normalized_layers]
         
-    def terrace_area(self):
+    @property
+    def terraces(self):
         
-        layers = self.layers[0]
-        grid_crystal = self.grid_crystal
-        z_step = next((vec[2] for vec in self.basis_vectors if vec[2] > 0), None)
-        z_steps = round(self.crystal_size[2]/z_step + 1)
-        sites_per_layer = len(grid_crystal)/z_steps
-
+        layers = self.occupancy_layers
+        sites_per_layer = self.sites_per_layer
         area_per_site = self.crystal_size[0] * self.crystal_size[1] / sites_per_layer
         
         terraces = [(sites_per_layer - layers[0])* area_per_site]
         terraces.extend((layers[i-1] - layers[i]) * area_per_site for i in range(1,len(layers)))
         terraces.append(layers[-1] * area_per_site) # (nm2)
         
-        self.terraces = terraces
+        return terraces
+        
+    def sites_occupation(self):
+        
+        # Compacted layers of the active window included
+        self.fraction_sites_occupied = ((len(self.sites_occupied) + self.active_window.n_occupied) 
+                                        / (len(self.grid_crystal) + self.active_window.n_sites))
         
     def RMS_roughness(self):
         
-        x,y,z = self.obtain_surface_coord()
-        z = np.array(z)
+        # Reduction over the (x,y) columns of the surface height map
+        z = self.surface_height[~np.isnan(self.surface_height)]
         z_mean = np.mean(z)
-        self.Ra_roughness = sum(abs(z-z_mean))/len(z)
+        self.Ra_roughness = np.mean(np.abs(z-z_mean))
         self.z_mean = z_mean
         self.surf_roughness_RMS = np.sqrt(np.mean((z-z_mean)**2))
         
@@ -1156,133 +1403,93 @@ class Crystal_Lattice():
                 
         self.histogram_neighbors = histogram_neighbors
     
+# =============================================================================
+#     Islands are tracked during the simulation (island_tracker)
+#     - Island base: the lowest layer of the island that is not complete
+# =============================================================================
     def islands_analysis(self):
 
-        # visited = set()
-        island_visited = set()
-        total_visited = set()
-
-        normalized_layers = self.layers[1]
-        count_islands = [0] * len(normalized_layers)
-        layers_no_complete = np.where(np.array(normalized_layers) != 1.0)
-        count_islands[normalized_layers == 1] = 1
-        z_step = next((vec[2] for vec in self.basis_vectors if vec[2] > 0), None)
-
-
+        # Islands start above the complete layers: the particles of a complete layer
+        # are included in the islands connected to it, but they are not the base
+        complete_layers = {z_idx for z_idx,count in enumerate(self.occupancy_layers) if count == self.sites_per_layer}
         islands_list = []
-
-        for z_idx in layers_no_complete[0]:    
-            z_layer = round(z_idx * z_step,3)
-            for idx_site in self.sites_occupied:     
-                if self.grid_crystal[idx_site].position[2] == z_layer: 
-                    island_slice = set()
-                    total_visited,island_slice = self.detect_islands(idx_site,total_visited,island_slice,self.chemical_specie)
-
-                    if len(island_slice):
-                        island_visited = island_slice.copy()
-                        island_sites = island_slice.copy()
-                        island_visited,island_sites = self.build_island(island_visited,island_sites,list(island_slice)[0],self.chemical_specie)
-                        islands_list.append(Island(z_idx,z_layer,island_sites))
-                        count_islands[z_idx] += 1
-                        total_visited.update(island_visited)
-
-
-                        
-        self.islands_list = islands_list
         
-# =============================================================================
-#     Function to detect island and the coordinates of the base
-# =============================================================================
-    def detect_islands(self,idx_site,visited,island_slice,chemical_specie):
-
-        site = self.grid_crystal[idx_site] 
+        for island,island_sites in self.island_tracker.islands.items():
+            layers = [z_idx for z_idx in self.island_tracker.islands_layers[island] if z_idx not in complete_layers]
+            if not layers: continue
+            z_idx = min(layers)
+            z_layer = round(z_idx * self.z_step,3)
+            islands_list.append(Island(z_idx,z_layer,island_sites.copy()))
+                        
+        self.islands_list = sorted(islands_list,key = lambda island: island.z_starting_position)
         
-        if idx_site not in visited and site.chemical_specie == chemical_specie:
-            visited.add(idx_site)
-            island_slice.add(idx_site)
-            # dfs_recursive
-            for idx in site.migration_paths['Plane']:
-                if idx[0] not in visited:
-                    visited,island_slice = self.detect_islands(idx[0],visited,island_slice,chemical_specie)
-                                       
-        return visited,island_slice
-
 # =============================================================================
-#     Function to build the full island starting from the base obtained in detect_islands()
+#     Peaks: groups of connected particles above the average thickness,
+#     including the particles below the thickness that support them
+#     - Vectorized: positions and neighbors of grid_crystal are cached as arrays
+#       and the connected components are calculated with scipy.sparse.csgraph
 # =============================================================================
-    def build_island_2(self,visited,island_sites,idx,chemical_specie):
-          
-        site = self.grid_crystal[idx]
-            
-        for element in site.migration_paths['Up'] + site.migration_paths['Plane']+site.migration_paths['Down']:
-    
-            if element[0] not in visited and self.grid_crystal[element[0]].chemical_specie == chemical_specie:
-                visited.add(element[0])
-                island_sites.add(element[0])
-                visited,island_sites = self.build_island(visited,island_sites,element[0],chemical_specie)
-                
-        return visited,island_sites
-    
-    def build_island(self,visited,island_sites,start_idx,chemical_specie):
-          
-        stack = [start_idx]
-
-        while stack:
-            idx = stack.pop()
-            site = self.grid_crystal[idx]
-            
-            for element in site.migration_paths['Up'] + site.migration_paths['Plane'] + site.migration_paths['Down']:
-        
-                if element[0] not in visited and self.grid_crystal[element[0]].chemical_specie == chemical_specie:
-                    visited.add(element[0])
-                    island_sites.add(element[0])
-                    stack.append(element[0])
-
-        return visited,island_sites
-    
-    
     def peak_detection(self):
         
-        chemical_specie = self.chemical_specie
+        from scipy.sparse.csgraph import connected_components
+        
         thickness = self.thickness
-        sites_occupied = self.sites_occupied
-    
-        # Convert occupied sites to Cartesian coordinates and sort by z-coordinate in descending order
-        sites_occupied_cart = sorted(
-            ((self.idx_to_cart(site), site) for site in sites_occupied), 
-            key=lambda coord: coord[0][2], 
-            reverse=True
-        )
-    
-        total_visited = set()
+        self.peak_list = []
+        
+        # The highest particle is always a surface point: z + z_step
+        if np.all(np.isnan(self.surface_height)) or np.nanmax(self.surface_height) - self.z_step <= thickness: 
+            return
+        
+        self.site_arrays()
+        occupied = np.zeros(len(self.site_list),dtype = bool)
+        occupied[[self.site_index[idx] for idx in self.sites_occupied]] = True
+        above = np.flatnonzero(occupied & (self.positions[:,2] > thickness))
+        
+        # Connected components of the particles above the thickness
+        n_peaks, labels = connected_components(self.neighbor_graph[above][:,above], directed = False)
+        
+        # Highest particle of each peak
+        order = np.lexsort((-self.positions[above,2], labels))
+        first = np.r_[0, np.flatnonzero(np.diff(labels[order])) + 1]
+        top_sites = above[order[first]]
+        
+        # Particles of each peak: particles above the thickness and the occupied neighbors
+        neighbors = self.neighbor_graph[above].tocoo()
+        occupied_neighbors = occupied[neighbors.col]
+        peak_labels = np.r_[labels, labels[neighbors.row[occupied_neighbors]]]
+        peak_sites = np.r_[above, neighbors.col[occupied_neighbors]]
+        order = np.argsort(peak_labels, kind = 'stable')
+        splits = np.flatnonzero(np.diff(peak_labels[order])) + 1
+        
         peak_list = []
+        for top_site, sites in zip(top_sites, np.split(peak_sites[order],splits)):
+            site = self.site_list[top_site]
+            cart_coords = tuple(np.round(self.positions[top_site],3))
+            peak_list.append(Island(site,cart_coords,{self.site_list[i] for i in sites}))
+            
+        # From the highest to the lowest peak
+        self.peak_list = sorted(peak_list, key = lambda peak: peak.z_starting_pos_cart[2], reverse = True)
+        
+    def site_arrays(self):
+        
+        # grid_crystal only changes when the active window compacts layers: we only build the arrays once
+        if hasattr(self,'neighbor_graph'): return
+        
+        from scipy.sparse import csr_matrix
+        
+        self.site_list = list(self.grid_crystal.keys())
+        self.site_index = {idx:i for i,idx in enumerate(self.site_list)}
+        self.positions = np.array([self.grid_crystal[idx].position for idx in self.site_list])
         
-        for cart_coords, site in sites_occupied_cart:
-            if site not in total_visited and cart_coords[2] > thickness:
-                peak_sites = self.build_peak({site},site,chemical_specie,thickness)
-                peak_list.append(Island(site,cart_coords,peak_sites))
-                total_visited.update(peak_sites)
+        rows = []
+        cols = []
+        for i,idx in enumerate(self.site_list):
+            for neighbor in self.grid_crystal[idx].nearest_neighbors_idx:
+                rows.append(i)
+                cols.append(self.site_index[neighbor])
                 
-        self.peak_list = peak_list
-    
-    def build_peak(self,peak_sites,start_idx,chemical_specie,thickness):
-         
-        grid_crystal = self.grid_crystal
-        stack = [start_idx]
-    
-        while stack:
-            idx = stack.pop()
-            site = grid_crystal[idx]
-            
-            for element in site.migration_paths['Up'] + site.migration_paths['Plane'] + site.migration_paths['Down']:
-    
-                if element[0] not in peak_sites and grid_crystal[element[0]].chemical_specie == chemical_specie:
-                    peak_sites.add(element[0])
-                    
-                    if self.idx_to_cart(element[0])[2] > thickness:
-                        stack.append(element[0])
-    
-        return peak_sites    
+        self.neighbor_graph = csr_matrix((np.ones(len(rows),dtype = bool),(rows,cols)),
+                                         shape = (len(self.site_list),len(self.site_list)))
  
 # =============================================================================
 #     Auxiliary functions
@@ -1405,28 +1612,88 @@ class Crystal_Lattice():
     
 
     
-    def obtain_surface_coord(self):
+# =============================================================================
+#     Surface height map
+#     Surface points: 
+#         - Occupied sites with at least two empty sites above -> z + z_step
+#         - Empty sites at the bottom layer with at least two empty sites above -> z
+#     The height of each (x,y) column is the highest surface point in that column.
+#     When a site changes its occupation, only the surface points of that site and 
+#     the sites below it (migration_paths['Down']) can change
+# =============================================================================
+    def surface_height_map(self):
+        
+        # Columns: sites with the same (x,y) coordinates
+        columns = {}
+        self.site_column = {}
+        for idx,site in self.grid_crystal.items():
+            key = (round(site.position[0],3), round(site.position[1],3))
+            if key not in columns:
+                columns[key] = (len(columns),site.position[:2])
+            self.site_column[idx] = columns[key][0]
+            
+        self.columns_xy = np.array([position for i,position in columns.values()])
+        
+        # Number of surface points for each column and layer (the layer above the top layer included)
+        self.surface_points = np.zeros((len(columns),self.z_steps + 1),dtype = np.int8)
+        self.surface_height = np.full(len(columns),np.nan)
+        self.site_surface_level = {}
+        
+        self.surface_dependents_map()
+        for idx in self.grid_crystal:
+            self.update_surface_point(idx)
+            
+    def surface_dependents_map(self):
+        
+        # The surface point of a site depends on the sites of its Up paths: reverse map
+        # (at the periodic boundaries the Down paths are not the inverse of the Up paths)
+        self.surface_dependents = {idx:[] for idx in self.grid_crystal}
+        for idx,site in self.grid_crystal.items():
+            for site_idx,num_event in site.migration_paths['Up']:
+                self.surface_dependents[site_idx].append(idx)
+            
+    def update_surface_height(self,idx):
+        
+        self.update_surface_point(idx)
+        for site_idx in self.surface_dependents[idx]:
+            self.update_surface_point(site_idx)
+            
+    def update_surface_point(self,idx):
         
         grid_crystal = self.grid_crystal
-        z_step = next((vec[2] for vec in self.basis_vectors if vec[2] > 0), None)
-
-        x = []
-        y = []
-        z = []
-        
-        for site in grid_crystal.values():
-            top_layer_empty_sites = 0
-            for jump in site.migration_paths['Up']:
-                if grid_crystal[jump[0]].chemical_specie == 'Empty': top_layer_empty_sites +=1
-                     
-            if (site.chemical_specie != 'Empty') and top_layer_empty_sites >= 2:
-                x.append(site.position[0])
-                y.append(site.position[1])
-                z.append(site.position[2]+z_step)
-                
-            elif (site.chemical_specie == 'Empty') and ('bottom_layer' in site.supp_by) and top_layer_empty_sites >= 2:
-                x.append(site.position[0])
-                y.append(site.position[1])
-                z.append(site.position[2])
+        site = grid_crystal[idx]
+        
+        top_layer_empty_sites = 0
+        for jump in site.migration_paths['Up']:
+            if grid_crystal[jump[0]].chemical_specie == 'Empty': top_layer_empty_sites +=1
+            
+        z_idx = self.layer_index(idx)
+        if (site.chemical_specie != 'Empty') and top_layer_empty_sites >= 2:
+            level = z_idx + 1
+        elif (site.chemical_specie == 'Empty') and z_idx == 0 and top_layer_empty_sites >= 2:
+            level = 0
+        else:
+            level = None
+            
+        previous_level = self.site_surface_level.get(idx)
+        if level == previous_level: return
+        
+        column = self.site_column[idx]
+        if previous_level is not None:
+            self.surface_points[column,previous_level] -= 1
+            del self.site_surface_level[idx]
+        if level is not None:
+            self.surface_points[column,level] += 1
+            self.site_surface_level[idx] = level
+            
+        levels = np.flatnonzero(self.surface_points[column])
+        self.surface_height[column] = levels[-1] * self.z_step if levels.size else np.nan
+    
+    def obtain_surface_coord(self):
+        
+        columns_surface = ~np.isnan(self.surface_height)
+        x = self.columns_xy[columns_surface,0]
+        y = self.columns_xy[columns_surface,1]
+        z = self.surface_height[columns_surface]
                 
-        return x,y,z
\ No newline at end of file
+        return x,y,z
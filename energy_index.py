@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+Energy index: occupied sites by the lowest activation energy of their events
+"""
+import math
+
+
+# =============================================================================
+# Index of the occupied sites by the lowest activation energy of their events
+#     - Updated every time the events of a site are recalculated (update_sites)
+#     - Sites are grouped in buckets of width bucket_width (energy_step)
+#     - query(E_min): sites with some event with activation energy <= E_min,
+#       only the buckets below E_min are visited and only the last one is checked
+#       site by site. Changing E_min does not require any update
+# =============================================================================
+
+class Energy_Index():
+
+    def __init__(self,bucket_width):
+
+        self.bucket_width = bucket_width
+        self.site_energy = {} # Site -> lowest activation energy of its events
+        self.buckets = {} # Bucket -> sites (dict as ordered set)
+
+    def bucket(self,energy):
+        return math.floor(energy / self.bucket_width)
+
+    def update(self,idx,site_events):
+
+        self.remove(idx)
+        if not site_events: return
+
+        energy = min(event[3] for event in site_events)
+        self.site_energy[idx] = energy
+        self.buckets.setdefault(self.bucket(energy),{})[idx] = None
+
+    def remove(self,idx):
+
+        if idx not in self.site_energy: return
+
+        bucket = self.bucket(self.site_energy.pop(idx))
+        del self.buckets[bucket][idx]
+        if not self.buckets[bucket]:
+            del self.buckets[bucket]
+
+    def query(self,E_max):
+
+        last_bucket = self.bucket(E_max)
+        sites = []
+
+        for bucket in sorted(self.buckets):
+            if bucket < last_bucket:
+                sites.extend(self.buckets[bucket])
+            elif bucket == last_bucket:
+                sites.extend(idx for idx in self.buckets[bucket] if self.site_energy[idx] <= E_max)
+            else:
+                break
+
+        return sites
+
+    def __len__(self):
+        return len(self.site_energy)
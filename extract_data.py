@@ -96,7 +96,6 @@ for subs in folder_subs:
                 peak_mean_size = np.mean(peak_size)
                 peak_std_size = np.std(peak_size)
                 islands_terraces = []
-                System_state.terrace_area()
                 for island in System_state.islands_list:
                     island.layers_calculation(System_state)
                     islands_terraces.append(np.mean(np.array(island.terraces)[np.array(island.terraces) != 0]))
@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+"""
+First-passage KMC: protective domains for isolated adatoms on flat terraces
+"""
+import numpy as np
+import heapq
+
+
+# =============================================================================
+# First-passage KMC for isolated adatoms on flat terraces
+# Oppelstrup, T., Bulatov, V. V., Donev, A., Kalos, M. H., Gilmer, G. H., & Sadigh, B. (2009).
+# First-passage kinetic Monte Carlo method. Physical Review E, 80(6), 066701.
+# https://doi.org/10.1103/PhysRevE.80.066701
+#
+#     - Walker: particle whose events are the 6 migrations in the plane with the same
+#       activation energy (flat (111) terrace or substrate) and whose protective domain
+#       (hexagon of radius R, in jumps) is empty, flat and fully supported
+#     - Instead of simulating every jump, we sample from a table the number of jumps
+#       and the path until the walker reaches the border of the hexagon (exit). The
+#       exit time is the time of N jumps with total rate 6k: Gamma(N, 1/6k)
+#     - The walkers are not in the catalog of events of KMC(). The walker with the
+#       earliest exit is moved to the exit site when it happens before the next event
+#     - Disruption: an event inside the domain of a walker (deposition, particle
+#       arriving...). The jumps done by the walker until then follow a binomial
+#       distribution (the first N-1 jump times are uniform between the protection and
+#       the exit), so its position is the path of the table at that jump
+#
+# The table of exits is a random walk on the hexagonal lattice in axial coordinates,
+# generated once for each radius. grid_crystal keeps the walker at the site where it
+# was protected until it exits or it is disrupted
+# The walkers are in a heap by exit time: the entries of released walkers are
+# discarded when they reach the top. The moves of the walkers have their own event
+# label (num_event: after the superbasin migration and the deposition)
+# =============================================================================
+
+# Directions of the hexagonal lattice (axial coordinates)
+AXIAL_DIRECTIONS = ((1,0),(0,1),(-1,1),(-1,0),(0,-1),(1,-1))
+
+class First_Passage():
+
+    def __init__(self,active = False,min_radius = 2,max_radius = 6,n_samples = 20000,seed = 0):
+
+        self.active = active
+        self.min_radius = min_radius
+        self.max_radius = max_radius
+        self.n_samples = n_samples
+        self.seed = seed
+        self.tables = {} # Radius -> jumps until the exit and path of each sample
+        self.walkers = {} # Site -> Walker
+        self.domain_index = {} # Site -> walker whose domain contains the site
+        self.exit_queue = [] # Heap of (exit time, order of protection, walker)
+        self.n_protected = 0
+
+    def __getstate__(self):
+
+        # The tables are generated again when they are needed
+        state = self.__dict__.copy()
+        state['tables'] = {}
+        return state
+
+    def __setstate__(self,state):
+
+        self.__dict__.update(state)
+        if 'exit_queue' not in state:
+            self.exit_queue = []
+            self.n_protected = 0
+            for walker in self.walkers.values():
+                self.push(walker)
+
+    def exit_table(self,radius):
+
+        if radius not in self.tables:
+            rng = np.random.default_rng(self.seed + radius)
+            directions = np.array(AXIAL_DIRECTIONS)
+            position = np.zeros((self.n_samples,2),dtype = int)
+            alive = np.ones(self.n_samples,dtype = bool)
+            jumps = np.zeros(self.n_samples,dtype = int)
+            path = [position.copy()]
+
+            while alive.any():
+                step = directions[rng.integers(len(directions),size = self.n_samples)]
+                position[alive] += step[alive]
+                jumps[alive] += 1
+                path.append(position.copy())
+                hex_distance = (np.abs(position[:,0]) + np.abs(position[:,1]) + np.abs(position.sum(axis = 1))) // 2
+                alive &= hex_distance < radius
+
+            self.tables[radius] = (jumps,np.array(path,dtype = np.int8))
+
+        return self.tables[radius]
+
+# =============================================================================
+#     Protective domain
+# =============================================================================
+    def protect(self,idx,System_state,rng,time = None):
+
+        # time: time of the event that left the particle there (System_state.time
+        # is only advanced after the event)
+        if time is None: time = System_state.time
+        grid_crystal = System_state.grid_crystal
+        site = grid_crystal[idx]
+
+        if (idx in self.walkers or idx in self.domain_index or idx in System_state.superbasin_dict
+            or site.chemical_specie == 'Empty' or len(site.site_events) != 6
+            or len(site.migration_paths['Plane']) != 6):
+            return False
+
+        # Only the 6 migrations in the plane with the same activation energy
+        plane_sites = {site_idx for site_idx,num_event in site.migration_paths['Plane']}
+        if any(event[1] not in plane_sites for event in site.site_events): return False
+        if len({event[3] for event in site.site_events}) != 1: return False
+
+        axial_vectors = self.axial_vectors(idx,System_state)
+        if axial_vectors is None: return False
+
+        radius,domain = self.protective_domain(idx,System_state)
+        if radius < self.min_radius: return False
+
+        jumps,path = self.exit_table(radius)
+        sample = rng.integers(len(jumps))
+        rate = 6 * site.site_events[0][0]
+
+        walker = Walker(idx,time,time + rng.gamma(jumps[sample],1 / rate),
+                        radius,sample,axial_vectors,domain)
+        self.walkers[idx] = walker
+        for site_idx in domain:
+            self.domain_index[site_idx] = walker
+        self.push(walker)
+
+        return True
+
+    def push(self,walker):
+
+        heapq.heappush(self.exit_queue,(walker.exit_time,self.n_protected,walker))
+        self.n_protected += 1
+
+    def protective_domain(self,idx,System_state):
+
+        # Rings of sites around idx: each ring k must have 6k empty sites, with the
+        # same support (flat terrace) and nothing above. Radius R: rings 1...R pass the
+        # test and ring R+1 is empty (no particle next to the domain)
+        grid_crystal = System_state.grid_crystal
+        site = grid_crystal[idx]
+        bottom_layer = 'bottom_layer' in site.supp_by
+        wulff_facet = getattr(site,'wulff_facet',None)
+
+        visited = {idx}
+        rings = [[idx]]
+        radius = 0
+
+        for k in range(1,self.max_radius + 2):
+            ring = []
+            for ring_idx in rings[-1]:
+                for site_idx,num_event in grid_crystal[ring_idx].migration_paths['Plane']:
+                    if site_idx not in visited:
+                        visited.add(site_idx)
+                        ring.append(site_idx)
+
+            # The hexagon overlaps with itself (periodic boundaries)
+            if len(ring) != 6 * k: break
+            if any(grid_crystal[site_idx].chemical_specie != 'Empty' or site_idx in self.domain_index
+                   for site_idx in ring): break
+
+            rings.append(ring)
+            radius = k - 1
+            if k == self.max_radius + 1: break
+
+            flat = all(len(grid_crystal[site_idx].migration_paths['Plane']) == 6
+                       and getattr(grid_crystal[site_idx],'wulff_facet',None) == wulff_facet
+                       and ('bottom_layer' in grid_crystal[site_idx].supp_by) == bottom_layer
+                       and all(grid_crystal[up_idx].chemical_specie == 'Empty' and up_idx not in self.domain_index
+                               for up_idx,num_event in grid_crystal[site_idx].migration_paths['Up'])
+                       and all(grid_crystal[down_idx].chemical_specie != 'Empty'
+                               for down_idx,num_event in grid_crystal[site_idx].migration_paths['Down'])
+                       for site_idx in ring)
+            if not flat: break
+
+        # Domain: rings 0...R+1 and the sites above and below rings 0...R
+        domain = set()
+        for k,ring in enumerate(rings[:radius + 2]):
+            domain.update(ring)
+            if k <= radius:
+                for site_idx in ring:
+                    domain.update(up_idx for up_idx,num_event in grid_crystal[site_idx].migration_paths['Up'])
+                    domain.update(down_idx for down_idx,num_event in grid_crystal[site_idx].migration_paths['Down'])
+
+        return radius,domain
+
+    def axial_vectors(self,idx,System_state):
+
+        # Cartesian vectors of the axial directions (1,0) and (0,1) - 60 degrees
+        vectors = [self.displacement(idx,site_idx,System_state) for site_idx,num_event
+                   in System_state.grid_crystal[idx].migration_paths['Plane']]
+        v1 = vectors[0]
+        for v2 in vectors[1:]:
+            cos_angle = np.dot(v1,v2) / (np.linalg.norm(v1) * np.linalg.norm(v2))
+            if abs(cos_angle - 0.5) < 1e-3 and v1[0] * v2[1] - v1[1] * v2[0] > 0:
+                break
+        else:
+            return None
+
+        # The 6 migrations must be the directions of the hexagonal lattice
+        basis = np.array([v1[:2],v2[:2]]).T
+        axial = {tuple(np.rint(np.linalg.solve(basis,v[:2])).astype(int)) for v in vectors}
+        if axial != set(AXIAL_DIRECTIONS): return None
+
+        return v1,v2
+
+    def displacement(self,idx_origin,idx_destination,System_state):
+
+        # Minimum image in the xy plane (periodic boundaries)
+        v = np.array(System_state.grid_crystal[idx_destination].position) - np.array(System_state.grid_crystal[idx_origin].position)
+        for i in range(2):
+            v[i] -= System_state.crystal_size[i] * np.rint(v[i] / System_state.crystal_size[i])
+        return v
+
+    def axial_site(self,walker,axial_position,System_state):
+
+        # Follow the migrations in the plane from the site of protection
+        grid_crystal = System_state.grid_crystal
+        idx = walker.idx
+        for direction,n_jumps in zip(walker.axial_vectors,axial_position):
+            direction = np.sign(n_jumps) * direction
+            for _ in range(abs(int(n_jumps))):
+                idx = max((site_idx for site_idx,num_event in grid_crystal[idx].migration_paths['Plane']),
+                          key = lambda site_idx: np.dot(self.displacement(idx,site_idx,System_state),direction))
+        return idx
+
+# =============================================================================
+#     Exit and disruption of the walkers
+# =============================================================================
+    def next_exit(self):
+
+        # Entries of released walkers are discarded
+        exit_queue = self.exit_queue
+        while exit_queue and self.walkers.get(exit_queue[0][2].idx) is not exit_queue[0][2]:
+            heapq.heappop(exit_queue)
+        return exit_queue[0][2] if exit_queue else None
+
+    def release(self,walker):
+
+        del self.walkers[walker.idx]
+        for site_idx in walker.domain:
+            if self.domain_index.get(site_idx) is walker:
+                del self.domain_index[site_idx]
+
+        # Too many entries of released walkers: the heap is built again
+        if len(self.exit_queue) > 2 * len(self.walkers) + 64:
+            self.exit_queue = [entry for entry in self.exit_queue if self.walkers.get(entry[2].idx) is entry[2]]
+            heapq.heapify(self.exit_queue)
+
+    def move_walker(self,walker,n_jumps,System_state):
+
+        # The walker is placed at the jump n_jumps of its path
+        jumps,path = self.exit_table(walker.radius)
+        idx = self.axial_site(walker,path[n_jumps,walker.sample],System_state)
+        self.release(walker)
+
+        if idx != walker.idx:
+            event = (0,idx,System_state.num_event,walker.idx)
+            System_state.processes(event)
+            System_state.update_superbasin(event)
+        return idx
+
+    def exit(self,walker,System_state):
+
+        jumps,path = self.exit_table(walker.radius)
+        return self.move_walker(walker,jumps[walker.sample],System_state)
+
+    def disrupt(self,chosen_event,time,System_state,rng):
+
+        # Walkers with the origin or the destination of the event in their domain
+        walkers = {self.domain_index[idx] for idx in (chosen_event[1],chosen_event[-1]) if idx in self.domain_index}
+
+        return [self.place(walker,time,System_state,rng) for walker in walkers]
+
+    def interrupt(self,time,System_state,rng):
+
+        # All the walkers (e.g. the rates change with the temperature)
+        return [self.place(walker,time,System_state,rng) for walker in list(self.walkers.values())]
+
+    def place(self,walker,time,System_state,rng):
+
+        # The walker is moved to where it is at this time
+        jumps,path = self.exit_table(walker.radius)
+        fraction = (time - walker.start_time) / (walker.exit_time - walker.start_time)
+        n_jumps = rng.binomial(jumps[walker.sample] - 1,min(max(fraction,0),1))
+        return self.move_walker(walker,n_jumps,System_state)
+
+class Walker():
+
+    def __init__(self,idx,start_time,exit_time,radius,sample,axial_vectors,domain):
+
+        self.idx = idx
+        self.start_time = start_time
+        self.exit_time = exit_time
+        self.radius = radius
+        self.sample = sample
+        self.axial_vectors = axial_vectors
+        self.domain = domain
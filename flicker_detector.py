@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Flicker detector: particles moving back and forth between the same sites
+"""
+
+
+# =============================================================================
+# Flicker detector - Particles moving back and forth between the same sites
+#     - Ring buffer with the last `window` events (origin, destination). Memory
+#       does not grow with the number of KMC steps
+#     - pair_count: (origin, destination) -> number of events in the window.
+#       An event is a return if the reverse move (destination, origin) is in the
+#       window. The returns in the window are counted on the fly (O(1) per event)
+#     - flickering(): the window is full and at least a fraction (flicker_fraction)
+#       of the events are returns. The number of particles can be constant while
+#       atoms move around, or change while atoms flicker, so we don't look at it
+#     - flickering_sites(): sites of the moves that were reversed - Candidates for
+#       the superbasin search
+#     - site_count: site -> number of events from/to the site in the window
+#       (priority of the superbasin search)
+# Depositions fill the window but they are never returns
+# =============================================================================
+
+class Flicker_Detector():
+
+    def __init__(self,window,flicker_fraction = 0.5):
+
+        self.window = max(int(window),1)
+        self.flicker_fraction = flicker_fraction
+        self.buffer = [None] * self.window # (origin, destination, return)
+        self.position = 0 # Next slot of the ring buffer
+        self.n_events = 0 # Events in the window
+        self.returns = 0 # Returns in the window
+        self.pair_count = {}
+        self.site_count = {}
+
+    def record_event(self,chosen_event):
+
+        idx_origin = chosen_event[1]
+        idx_destination = chosen_event[-1]
+
+        # The oldest event leaves the window
+        if self.n_events == self.window:
+            self.forget(self.buffer[self.position])
+        else:
+            self.n_events += 1
+
+        if idx_origin == idx_destination: # Deposition
+            entry = None
+        else:
+            is_return = (idx_destination,idx_origin) in self.pair_count
+            entry = (idx_origin,idx_destination,is_return)
+            self.returns += is_return
+            pair = (idx_origin,idx_destination)
+            self.pair_count[pair] = self.pair_count.get(pair,0) + 1
+            for idx in (idx_origin,idx_destination):
+                self.site_count[idx] = self.site_count.get(idx,0) + 1
+
+        self.buffer[self.position] = entry
+        self.position = (self.position + 1) % self.window
+
+    def forget(self,entry):
+
+        if entry is None: return
+
+        idx_origin,idx_destination,is_return = entry
+        self.returns -= is_return
+        pair = (idx_origin,idx_destination)
+        self.pair_count[pair] -= 1
+        if self.pair_count[pair] == 0:
+            del self.pair_count[pair]
+        for idx in (idx_origin,idx_destination):
+            self.site_count[idx] -= 1
+            if self.site_count[idx] == 0:
+                del self.site_count[idx]
+
+    def flickering(self):
+        return self.n_events == self.window and self.returns >= self.flicker_fraction * self.window
+
+    def flickering_sites(self):
+
+        sites = set()
+        for idx_origin,idx_destination in self.pair_count:
+            if (idx_destination,idx_origin) in self.pair_count:
+                sites.add(idx_origin)
+                sites.add(idx_destination)
+        return sites
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Indexed set: set with O(1) add, remove, membership and random selection
+"""
+
+# =============================================================================
+# Indexed set for sites_occupied and adsorption_sites
+#     - add, remove and membership in O(1) (dictionary: item -> position)
+#     - random selection in O(1) (list of items)
+#     - Iteration over the list: the order only depends on the sequence of
+#       add/remove operations, so the simulation is reproducible with the same seed
+#
+#     remove() moves the last item to the position of the removed one instead of
+#     shifting the list (list.remove() is O(N))
+# =============================================================================
+
+class Indexed_Set():
+
+    def __init__(self,items = ()):
+
+        self.items = []
+        self.position = {}
+
+        for item in items:
+            self.add(item)
+
+    def add(self,item):
+
+        if item not in self.position:
+            self.position[item] = len(self.items)
+            self.items.append(item)
+
+    def remove(self,item):
+
+        # Raise KeyError if item is not in the set, as set.remove()
+        i = self.position.pop(item)
+        last_item = self.items.pop()
+
+        # Move the last item to the empty position
+        if i < len(self.items):
+            self.items[i] = last_item
+            self.position[last_item] = i
+
+    def discard(self,item):
+
+        if item in self.position:
+            self.remove(item)
+
+    def random_choice(self,rng):
+        return self.items[rng.integers(len(self.items))]
+
+    def copy(self):
+
+        new_set = Indexed_Set()
+        new_set.items = self.items.copy()
+        new_set.position = self.position.copy()
+        return new_set
+
+    def __contains__(self,item):
+        return item in self.position
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __getitem__(self,i):
+        return self.items[i]
+
+    def __repr__(self):
+        return f"Indexed_Set({self.items})"
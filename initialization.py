@@ -5,20 +5,23 @@ Created on Wed Jan 10 15:03:03 2024
 @author: samuel.delgado
 """
 import numpy as np
-import matplotlib.pyplot as plt
 import platform
 import shutil
 from crystal_lattice import Crystal_Lattice
 from superbasin import Superbasin
-from pymatgen.ext.matproj import MPRester
+from indexed_set import Indexed_Set
+from random_buffer import Random_Buffer
+from temperature_schedule import Temperature_Schedule
 import json
 from pathlib import Path
 
 import os
 import pickle
-import shelve
 import time
 
+# matplotlib, shelve and MPRester (pymatgen) are imported where they are used
+# so headless runs (lammps_file = True) with a saved grid_crystal start fast
+
 
 
 def initialization(n_sim,save_data,lammps_file):
@@ -26,13 +29,20 @@ def initialization(n_sim,save_data,lammps_file):
     seed = 1
     # Random seed as time
     rng = np.random.default_rng(seed) # Random Number Generator (RNG) object
+    # Blocks of uniforms and exponentials for the KMC loop (reproducible from a checkpoint)
+    rng = Random_Buffer(rng)
 
-    # Default resolution for figures
-    plt.rcParams["figure.dpi"] = 100 # Default value of dpi = 300
+    # Default resolution for figures - Only needed when we plot with matplotlib
+    if not lammps_file:
+        import matplotlib.pyplot as plt
+        plt.rcParams["figure.dpi"] = 100 # Default value of dpi = 300
     
     if save_data:
         files_copy = ['initialization.py', 'crystal_lattice.py','Site.py','main.py','KMC.py',
-                      'balanced_tree.py','analysis.py','superbasin.py','activation_energies_deposition.json']
+                      'balanced_tree.py','analysis.py','superbasin.py','occupancy_overlay.py','indexed_set.py',
+                      'island_tracker.py','lattice_template.py','energy_index.py','superbasin_scheduler.py',
+                      'superbasin_telemetry.py','flicker_detector.py',
+                      'rate_rescaling.py','first_passage.py','random_buffer.py','active_window.py','temperature_schedule.py','activation_energies_deposition.json']
         
         if platform.system() == 'Windows': # When running in laptop
             dst = Path(r'\\FS1\Docs2\samuel.delgado\My Documents\Publications\Material deposition exploration\Simulations\Test')
@@ -85,6 +95,7 @@ def initialization(n_sim,save_data,lammps_file):
         interstitial = False
         radius_neighbors = 3
         sites_generation_layer = ['bottom_layer','top_layer']
+        active_window_depth = 0 # Layers kept below the lowest surface column (0: off) - see active_window.py
 
 
         script_directory = Path(__file__).parent        # Get the config path from the environment variable or fallback to the current directory
@@ -96,7 +107,7 @@ def initialization(n_sim,save_data,lammps_file):
             config = json.load(config_file)
             api_key = config['api_key']
         
-        mpr = MPRester(api_key)
+        from pymatgen.ext.matproj import MPRester
         # Retrieve material data
         with MPRester(api_key) as mpr:
             # Retrieve material summary information
@@ -104,7 +115,8 @@ def initialization(n_sim,save_data,lammps_file):
             formula = material_summary[0].formula_pretty
 
             
-        crystal_features = [id_material_Material_Project,crystal_size,orientation[1],api_key,use_parallel,facets_type,interstitial_specie,interstitial,radius_neighbors,sites_generation_layer[0]]
+        crystal_features = [id_material_Material_Project,crystal_size,orientation[1],api_key,use_parallel,facets_type,interstitial_specie,interstitial,radius_neighbors,sites_generation_layer[0],
+                            active_window_depth]
         
 # =============================================================================
 #             Superbasin parameters
@@ -114,7 +126,12 @@ def initialization(n_sim,save_data,lammps_file):
         time_step_limits = 1e-7 # Time needed for efficient evolution of the system
         E_min = 0.0
         energy_step = 0.05
-        superbasin_parameters = [n_search_superbasin,time_step_limits,E_min,energy_step]
+        superbasin_time_budget = 300 # Wall-clock time for each search of superbasins (s)
+        rate_rescaling = False # AS-KMC: scale down the rates of quasi-equilibrated processes instead of building superbasins
+        first_passage = False # Isolated adatoms on flat terraces jump to the border of a protective domain
+        tau_leaping = 0 # Adsorption by tau-leaps filling at most this fraction of the adsorption sites per leap (0: exact KMC)
+        superbasin_parameters = [n_search_superbasin,time_step_limits,E_min,energy_step,superbasin_time_budget,rate_rescaling,first_passage,
+                                 tau_leaping]
 # =============================================================================
 #       Different surface Structures- fcc Metals
 #       https://chem.libretexts.org/Bookshelves/Physical_and_Theoretical_Chemistry_Textbook_Maps/Surface_Science_(Nix)/01%3A_Structure_of_Solid_Surfaces/1.03%3A_Surface_Structures-_fcc_Metals
@@ -215,9 +232,13 @@ def initialization(n_sim,save_data,lammps_file):
                       binding_energy,E_clustering]
         
         
+        # Lattice templates: fcc materials (Ni, Cu, Pd, Ag, Pt, Au) with the same orientation and
+        # supercell share the lattice topology --> Only scaled by the lattice constant
+        template_path = script_directory / 'lattice_templates' # Not tracked by git (.gitignore)
+
         filename = 'grid_crystal'
         System_state = initialize_grid_crystal(filename,crystal_features,experimental_conditions,Act_E_list, 
-              lammps_file,superbasin_parameters,save_data)  
+              lammps_file,superbasin_parameters,save_data,template_path)  
 
         # The minimum energy to select transition pathways to create a superbasin should be smaller
         # than the adsorption energy
@@ -270,15 +291,26 @@ def initialization(n_sim,save_data,lammps_file):
             myvar = pickle.load(file)
             
         System_state = myvar['System_state']
+        # Continue with the same sequence of random numbers
+        if 'rng' in myvar: rng = myvar['rng']
+        # States saved with lists for sites_occupied and adsorption_sites
+        System_state.sites_occupied = Indexed_Set(System_state.sites_occupied)
+        System_state.adsorption_sites = Indexed_Set(System_state.adsorption_sites)
+        
+        # Temperature schedules: (time (s), T (K)) - Linear ramps between the points,
+        # holds between points with the same T and constant T after the last point
+        temperature_schedules = [[(0,300)],[(0,500)],[(0,800)],
+                                 [(0,300),(1e-3,800),(5e-3,800),(6e-3,300)]] # Ramp, hold and cooling
+        temperature_step = 10 # (K) Maximum change of T between two updates of the rates in the ramps
         
-        temp = [300,500,800] #(K)
-        
-        System_state.temperature = temp[n_sim]
         System_state.experiment = experiment
         P_limits = 1
         System_state.limit_kmc_timestep(P_limits)
         System_state.time = 0
         System_state.list_time = []
+        # The rates of the events are rescaled to the temperature of the schedule
+        System_state.temperature_schedule = Temperature_Schedule(temperature_schedules[n_sim],temperature_step)
+        System_state.temperature_schedule.start(System_state,rng)
         
     elif experiment == 'ECM memristor':
         # =============================================================================
@@ -306,6 +338,7 @@ def initialization(n_sim,save_data,lammps_file):
         interstitial = True
         radius_neighbors = 4
         sites_generation_layer = ['bottom_layer','top_layer']
+        active_window_depth = 0
 
 
         script_directory = Path(__file__).parent        # Get the config path from the environment variable or fallback to the current directory
@@ -317,7 +350,7 @@ def initialization(n_sim,save_data,lammps_file):
             config = json.load(config_file)
             api_key = config['api_key']
         
-        mpr = MPRester(api_key)
+        from pymatgen.ext.matproj import MPRester
         # Retrieve material data
         with MPRester(api_key) as mpr:
             # Retrieve material summary information
@@ -325,7 +358,8 @@ def initialization(n_sim,save_data,lammps_file):
             formula = material_summary[0].formula_pretty
 
 
-        crystal_features = [id_material_Material_Project,crystal_size,orientation[0],api_key,use_parallel,facets_type,interstitial_specie,interstitial,radius_neighbors,sites_generation_layer[1]]
+        crystal_features = [id_material_Material_Project,crystal_size,orientation[0],api_key,use_parallel,facets_type,interstitial_specie,interstitial,radius_neighbors,sites_generation_layer[1],
+                            active_window_depth]
         
         # =============================================================================
         #             Superbasin parameters
@@ -335,7 +369,12 @@ def initialization(n_sim,save_data,lammps_file):
         time_step_limits = 1e-7 # Time needed for efficient evolution of the system
         E_min = 0.0
         energy_step = 0.05
-        superbasin_parameters = [n_search_superbasin,time_step_limits,E_min,energy_step]
+        superbasin_time_budget = 300 # Wall-clock time for each search of superbasins (s)
+        rate_rescaling = False # AS-KMC: scale down the rates of quasi-equilibrated processes instead of building superbasins
+        first_passage = False # Isolated adatoms on flat terraces jump to the border of a protective domain
+        tau_leaping = 0 # Adsorption by tau-leaps filling at most this fraction of the adsorption sites per leap (0: exact KMC)
+        superbasin_parameters = [n_search_superbasin,time_step_limits,E_min,energy_step,superbasin_time_budget,rate_rescaling,first_passage,
+                                 tau_leaping]
         
         
         # =============================================================================
@@ -386,7 +425,7 @@ def initialization(n_sim,save_data,lammps_file):
     #     Initialize the crystal grid structure - nodes with empty spaces
     # =============================================================================    
 def initialize_grid_crystal(filename,crystal_features,experimental_conditions,Act_E_list, 
-    lammps_file,superbasin_parameters,save_data):
+    lammps_file,superbasin_parameters,save_data,template_path = None):
       
         # If grid_crystal exists: we loaded
         # Otherwise: we create it (very expensive for larger systems ~100 anstrongs)
@@ -401,6 +440,7 @@ def initialize_grid_crystal(filename,crystal_features,experimental_conditions,Ac
             print('Loading grid_crystal.dat')
             # Load from .dat
             dat_file = current_directory / f"{filename}"
+            import shelve
             with shelve.open(dat_file) as my_shelf:
                 grid_crystal = my_shelf.get(filename)
             
@@ -420,7 +460,10 @@ def initialize_grid_crystal(filename,crystal_features,experimental_conditions,Ac
         else:
             # Create new grid_crystal
             print('Creating grid_crystal')
-            System_state = Crystal_Lattice(crystal_features,experimental_conditions,Act_E_list,lammps_file,superbasin_parameters)
+            # If there is a lattice template for this structure, orientation and supercell, 
+            # it is only scaled by the lattice constant. Otherwise, we build it and save the template
+            System_state = Crystal_Lattice(crystal_features,experimental_conditions,Act_E_list,lammps_file,superbasin_parameters,
+                                           template_path = template_path)
             
             # Save the newly created data
             if save_data:
@@ -430,33 +473,163 @@ def initialize_grid_crystal(filename,crystal_features,experimental_conditions,Ac
         return System_state
         
         
-def search_superbasin(System_state):
+def search_superbasin(System_state,sites = None,use_parallel = None):
           
-    # We need a deepcopy? System_state.sites_occupied will be modified on site
-    # when calling Superbasin() and it will change the order of sites_occupied
-    # sites_occupied = copy.deepcopy(System_state.sites_occupied)
-    
-    # This approach should be more efficient and memory-friendly
-    sites_occupied = System_state.sites_occupied[:] 
-
     start_time = time.time()
-
-    for idx in sites_occupied:
-        for event in System_state.grid_crystal[idx].site_events:
-            if (idx not in System_state.superbasin_dict) and (event[3] <= System_state.E_min):
-                superbasin = Superbasin(idx, System_state, System_state.E_min,sites_occupied)
-                if superbasin.valid:    
-                    System_state.superbasin_dict.update({idx: superbasin})
+    superbasin_scheduler = System_state.superbasin_scheduler
+    superbasin_telemetry = System_state.superbasin_telemetry
+    # Wall-clock budget: we stop building superbasins at the deadline and keep the ones we have
+    deadline = start_time + superbasin_scheduler.time_budget
+    
+    # Particles with some event with activation energy below E_min 
+    # sites: only the particles at these sites (e.g. flickering sites)
+    # Priority queue: largest expected time gain first
+    candidates = [idx for idx in System_state.energy_index.query(System_state.E_min)
+                  if idx not in System_state.superbasin_dict and idx not in System_state.first_passage.walkers
+                  and (sites is None or idx in sites)]
+    candidates = superbasin_scheduler.prioritize(candidates,System_state)
+    
+    # Set default parallelization based on the number of candidates and cores
+    num_cores = System_state.get_num_cores()
+    if use_parallel is None:
+        use_parallel = len(candidates) > 50
+    
+    if use_parallel and num_cores > 1:
+        
+        import concurrent.futures
+        # The superbasins are explored on an occupancy overlay (read-only), so the
+        # candidates are independent. Each process receives a copy of System_state
+        # once per search (frozen snapshot of the occupancy) and then only batches of candidates
+        # Candidates close to each other are in the same batch, so the batches rarely 
+        # build overlapping superbasins (merge_superbasins() drops them). The groups 
+        # keep the order of priority
+        batches = [[] for i in range(num_cores)]
+        for group in candidate_groups(candidates,System_state):
+            min(batches,key = len).extend(group)
+        batches = [batch for batch in batches if batch]
+        
+        with concurrent.futures.ProcessPoolExecutor(max_workers=len(batches),initializer=superbasin_worker_init,
+                                                    initargs=(System_state,)) as executor:
+            results = list(executor.map(superbasin_worker, batches, [deadline] * len(batches)))
+            
+        # Combine results from all processes: superbasins and new entries of the cache
+        superbasins = []
+        for batch_superbasins,cache_entries in results:
+            superbasins.extend(batch_superbasins)
+            System_state.superbasin_cache.update(cache_entries)
+            
+        # Hits and misses of the cache in the other processes
+        hits = sum(superbasin.cached for _,superbasin in superbasins)
+        System_state.superbasin_cache.hits += hits
+        System_state.superbasin_cache.misses += len(superbasins) - hits
+        
+    else:
+        superbasins,_ = superbasin_batch(System_state,candidates,deadline)
+    
+    superbasins = merge_superbasins(System_state,candidates,superbasins,deadline)
     
     # Record the end time
     end_time = time.time()
     # Calculate the elapsed time
     elapsed_time = end_time - start_time
+    superbasin_telemetry.search_finished(System_state.E_min,len(candidates),len(superbasins),elapsed_time)
     
-    if elapsed_time > 300 and System_state.E_min_lim_superbasin > System_state.energy_step:
+    # The budget was not enough for all the candidates: smaller superbasins next time
+    # (candidates inside a superbasin are skipped, not left behind)
+    if end_time > deadline and System_state.E_min_lim_superbasin > System_state.energy_step:
         System_state.E_min -= System_state.energy_step
-    # print(f"Elapsed time superbasin: {elapsed_time} seconds")    
-    print("Superbasins generated: ",len(System_state.superbasin_dict))
+    
+    if superbasin_telemetry.verbose:
+        print("Superbasins generated: ",len(System_state.superbasin_dict),
+              f"| Candidates explored: {len(superbasins)}/{len(candidates)} in {elapsed_time:.1f} s")
+        
+        speedup_summary = superbasin_telemetry.speedup_summary()
+        if speedup_summary is not None:
+            print(f"Superbasin speedup (simulated time) | Mean: {speedup_summary[0]:.3g} | Max: {speedup_summary[1]:.3g}")
+    
+def superbasin_batch(System_state,candidates,deadline = None):
+    
+    # Superbasins of a batch of candidates (until the deadline) and the entries they 
+    # added to the cache (lost in the copy of System_state when running in other process)
+    cached = set(System_state.superbasin_cache.superbasins)
+    
+    superbasins = []
+    environment = set(System_state.superbasin_index) # Sites of the superbasins we keep
+    for idx in candidates:
+        if deadline is not None and time.time() > deadline: break
+        # The particle is part of a superbasin we keep
+        if idx in environment: continue
+        superbasin = Superbasin(idx, System_state, System_state.E_min)
+        superbasins.append((idx,superbasin))
+        if superbasin.valid and environment.isdisjoint(superbasin.superbasin_environment): 
+            environment.update(superbasin.superbasin_environment)
+        
+    cache_entries = {signature:entry for signature,entry in System_state.superbasin_cache.superbasins.items()
+                     if signature not in cached}
+    
+    return superbasins,cache_entries
+
+def merge_superbasins(System_state,candidates,superbasins,deadline):
+    
+    # Superbasins in order of priority: a superbasin is kept if it does not overlap the
+    # ones we already have. It is the result of superbasin_batch() with all the candidates,
+    # so the parallel search keeps the same superbasins as the serial one
+    #   - Candidates skipped in a batch because of a superbasin that is dropped here are built now
+    superbasin_telemetry = System_state.superbasin_telemetry
+    built = dict(superbasins)
+    environment = set(System_state.superbasin_index)
+    explored = []
+    
+    for idx in candidates:
+        if idx in environment: continue
+        superbasin = built.get(idx)
+        if superbasin is None:
+            if time.time() > deadline: continue
+            superbasin = Superbasin(idx, System_state, System_state.E_min)
+        explored.append((idx,superbasin))
+        
+        if superbasin.valid and environment.isdisjoint(superbasin.superbasin_environment):
+            superbasin_telemetry.superbasin_built(superbasin)
+            System_state.add_superbasin(idx,superbasin)
+            environment.update(superbasin.superbasin_environment)
+        elif not superbasin.valid:
+            superbasin_telemetry.superbasin_built(superbasin)
+            
+    return explored
+
+def candidate_groups(candidates,System_state):
+    
+    # Candidates that are neighbors or share a neighbor explore the same sites: same group
+    # Groups in order of priority of their first candidate
+    neighbors = System_state.island_tracker.neighbors
+    groups = {} # Group id -> candidates
+    site_group = {} # Site -> group id
+    
+    for i,idx in enumerate(candidates):
+        sites = [idx] + neighbors[idx]
+        group_ids = sorted({site_group[site] for site in sites if site in site_group})
+        group = group_ids[0] if group_ids else i
+        groups.setdefault(group,[]).append(idx)
+        for other_group in group_ids[1:]:
+            for other_idx in groups.pop(other_group):
+                groups[group].append(other_idx)
+                for site in [other_idx] + neighbors[other_idx]:
+                    site_group[site] = group
+        for site in sites:
+            site_group[site] = group
+            
+    priority = {idx:i for i,idx in enumerate(candidates)}
+    return [sorted(group,key = priority.get) for group in groups.values()]
+
+# Process of the pool: System_state is received once per search (initializer)
+_worker_state = None
+
+def superbasin_worker_init(System_state):
+    global _worker_state
+    _worker_state = System_state
+    
+def superbasin_worker(candidates,deadline):
+    return superbasin_batch(_worker_state,candidates,deadline)
         
 
 def save_simulation(files_copy,dst,n_sim):
@@ -505,6 +678,7 @@ def save_variables(paths,variables,filename):
     file_path = paths / filename
 
     if platform.system() == 'Windows':  # When running on Windows
+        import shelve
         with shelve.open(str(file_path), 'n') as my_shelf:
             for key, value in variables.items():
                 my_shelf[key] = value
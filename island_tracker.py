@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+Island tracker: groups of occupied sites connected through nearest neighbors
+"""
+from collections import deque
+
+
+# =============================================================================
+# Island tracker - Islands are the groups of occupied sites connected through
+# nearest neighbors. It is updated every time we introduce or remove a particle
+#     - Introduce: union of the islands of the occupied neighbors. The smaller
+#       islands are relabeled with the id of the largest one (union by size), so
+#       the island of a site is found in O(1)
+#     - Remove: if the particle connected two or more occupied neighbors, the
+#       island may split. We run a BFS from each neighbor at the same time and
+#       merge the searches when they meet. A search that finishes without meeting
+#       the others is a new island. The cost is proportional to the small pieces,
+#       not to the size of the island
+# =============================================================================
+
+class Island_Tracker():
+
+    def __init__(self,grid_crystal):
+
+        self.grid_crystal = grid_crystal
+        # Neighbors in both directions - At the periodic boundaries nearest_neighbors_idx
+        # is not always symmetric (a site can be neighbor of another without the reverse)
+        self.neighbors = {idx:dict.fromkeys(site.nearest_neighbors_idx) for idx,site in grid_crystal.items()}
+        for idx,site in grid_crystal.items():
+            for neighbor in site.nearest_neighbors_idx:
+                self.neighbors[neighbor][idx] = None
+        self.neighbors = {idx:list(neighbors) for idx,neighbors in self.neighbors.items()}
+        
+        self.island_id = {} # Site -> island id
+        self.islands = {} # Island id -> set of sites
+        self.islands_layers = {} # Island id -> {layer: number of sites}
+        self.site_layer = {} # Site -> layer
+        self.next_id = 0
+
+    def add_site(self,idx,z_idx):
+
+        if idx in self.island_id: return
+
+        neighbor_islands = {self.island_id[neighbor] for neighbor in self.neighbors[idx]
+                            if neighbor in self.island_id}
+
+        if neighbor_islands:
+            # Join all the islands in the largest one
+            island = max(neighbor_islands,key = lambda i: len(self.islands[i]))
+            for other_island in neighbor_islands - {island}:
+                self.merge_islands(island,other_island)
+        else:
+            island = self.new_island()
+
+        self.island_id[idx] = island
+        self.islands[island].add(idx)
+        self.site_layer[idx] = z_idx
+        self.islands_layers[island][z_idx] = self.islands_layers[island].get(z_idx,0) + 1
+
+    def remove_site(self,idx):
+
+        if idx not in self.island_id: return
+
+        island = self.island_id.pop(idx)
+        z_idx = self.site_layer.pop(idx)
+        self.islands[island].discard(idx)
+        self.islands_layers[island][z_idx] -= 1
+        if self.islands_layers[island][z_idx] == 0:
+            del self.islands_layers[island][z_idx]
+
+        if not self.islands[island]:
+            del self.islands[island]
+            del self.islands_layers[island]
+            return
+
+        neighbors = [neighbor for neighbor in self.neighbors[idx] if neighbor in self.island_id]
+
+        # A single neighbor cannot be disconnected from the rest of the island
+        if len(neighbors) > 1:
+            self.split_check(island,neighbors)
+
+    def release_site(self,idx):
+
+        # Site of a compacted layer (active_window): removed without checking if the
+        # island splits - The sites above are still connected through the frozen film
+        self.neighbors.pop(idx,None)
+        if idx not in self.island_id: return
+
+        island = self.island_id.pop(idx)
+        z_idx = self.site_layer.pop(idx)
+        self.islands[island].discard(idx)
+        self.islands_layers[island][z_idx] -= 1
+        if self.islands_layers[island][z_idx] == 0:
+            del self.islands_layers[island][z_idx]
+
+        if not self.islands[island]:
+            del self.islands[island]
+            del self.islands_layers[island]
+
+    def split_check(self,island,neighbors):
+
+        site_neighbors = self.neighbors
+
+        # One search for each neighbor - group[i] points to the search i was merged with
+        group = list(range(len(neighbors)))
+        owner = {neighbor:i for i,neighbor in enumerate(neighbors)}
+        queues = {i:deque([neighbor]) for i,neighbor in enumerate(neighbors)}
+        visited = {i:{neighbor} for i,neighbor in enumerate(neighbors)}
+        active = list(range(len(neighbors)))
+
+        def find(i):
+            while group[i] != i:
+                group[i] = group[group[i]]
+                i = group[i]
+            return i
+
+        while len(active) > 1:
+            for i in active[:]:
+                if i not in queues: continue # Merged in this round
+                queue = queues[i]
+
+                # The search finished without meeting the others: new island
+                if not queue:
+                    active.remove(i)
+                    del queues[i]
+                    self.detach_island(island,visited.pop(i))
+                    if len(active) == 1: break
+                    continue
+
+                site = queue.popleft()
+                for neighbor in site_neighbors[site]:
+                    if neighbor not in self.island_id: continue
+
+                    j = owner.get(neighbor)
+                    if j is None:
+                        owner[neighbor] = i
+                        visited[i].add(neighbor)
+                        queue.append(neighbor)
+                    else:
+                        j = find(j)
+                        if j != i:
+                            # Both searches are in the same island
+                            group[j] = i
+                            queue.extend(queues.pop(j))
+                            visited[i] |= visited.pop(j)
+                            active.remove(j)
+
+                if len(active) == 1: break
+
+    def merge_islands(self,island,other_island):
+
+        for site in self.islands[other_island]:
+            self.island_id[site] = island
+        self.islands[island] |= self.islands.pop(other_island)
+
+        for z_idx,count in self.islands_layers.pop(other_island).items():
+            self.islands_layers[island][z_idx] = self.islands_layers[island].get(z_idx,0) + count
+
+    def detach_island(self,island,sites):
+
+        new_island = self.new_island()
+        self.islands[island] -= sites
+        self.islands[new_island] = sites
+
+        for site in sites:
+            self.island_id[site] = new_island
+            z_idx = self.site_layer[site]
+            self.islands_layers[island][z_idx] -= 1
+            if self.islands_layers[island][z_idx] == 0:
+                del self.islands_layers[island][z_idx]
+            self.islands_layers[new_island][z_idx] = self.islands_layers[new_island].get(z_idx,0) + 1
+
+    def new_island(self):
+
+        island = self.next_id
+        self.next_id += 1
+        self.islands[island] = set()
+        self.islands_layers[island] = {}
+        return island
+
+# =============================================================================
+#     Island statistics
+# =============================================================================
+    @property
+    def n_islands(self):
+        return len(self.islands)
+
+    def island_size(self,island):
+        return len(self.islands[island])
+
+    def base_layer(self,island):
+        return min(self.islands_layers[island])
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Lattice templates: topology of grid_crystal shared by the materials with the same structure type
+"""
+import numpy as np
+import pickle
+from pathlib import Path
+from Site import Site
+
+
+# =============================================================================
+# Lattice templates: the topology of grid_crystal in reduced coordinates
+#
+# Materials with the same structure type (e.g. fcc Ni, Cu, Pd, Ag, Pt and Au)
+# only differ in the lattice constant. The integer indexes of grid_crystal, the
+# neighbors, the migration paths and event_labels are the same for the same
+# orientation, supercell size and radius of the neighbors. We store them once
+# with the positions divided by the lattice constant and we scale them with the
+# lattice constant of the selected material when loading.
+# The facets (wulff_facets, dir_edge_facets) depend on the surface energies of
+# each material: they are not stored and they are calculated for every material.
+#
+# Sites on the periodic boundary: a fresh build only keeps the neighbors whose
+# position does not change when it is wrapped into the supercell (crystal_grid(),
+# step 2). This comparison depends on the floating-point rounding of the positions,
+# which changes with the lattice constant. A grid loaded from a template keeps the
+# boundary sites of the material that created the template, so it can differ from a
+# fresh build of another material in a few sites on the periodic boundary (e.g. 488
+# and 495 sites for Cu with an Ag template). Remove the template to build the grid
+# of that material from scratch.
+# =============================================================================
+
+class Lattice_Template():
+
+    def __init__(self,System_state,structure_type,lattice_constant,radius_neighbors):
+
+        # Lattice constant in Angstrom - Positions and crystal size are in Angstrom
+        a = lattice_constant
+
+        self.structure_type = structure_type
+        self.orientation = System_state.latt_orientation
+        self.supercell = reduced_supercell(System_state.crystal_size,a)
+        self.radius_neighbors = radius_neighbors
+
+        self.crystal_size = tuple(np.array(System_state.crystal_size) / a)
+        self.domain_height = System_state.domain_height / a
+        self.num_event = System_state.num_event
+        self.event_labels = System_state.event_labels
+
+        # Topology of grid_crystal: reduced position, neighbors and migration paths
+        self.sites = {
+            idx:(tuple(np.array(site.position) / a),
+                 list(site.nearest_neighbors_idx),
+                 [tuple(np.array(pos) / a) for pos in site.nearest_neighbors_cart],
+                 {key:[list(path) for path in paths] for key,paths in site.migration_paths.items()})
+            for idx,site in System_state.grid_crystal.items()
+            }
+
+    def build_grid_crystal(self,lattice_constant,Act_E_list):
+
+        a = lattice_constant
+        grid_crystal = {}
+
+        for idx,(position,neighbors_idx,neighbors_cart,migration_paths) in self.sites.items():
+            site = Site("Empty",
+                        tuple(a * np.array(position)),
+                        Act_E_list)
+
+            site.nearest_neighbors_idx = list(neighbors_idx)
+            site.nearest_neighbors_cart = [tuple(a * np.array(pos)) for pos in neighbors_cart]
+            site.migration_paths = {key:[list(path) for path in paths] for key,paths in migration_paths.items()}
+            site.mig_paths_plane = {num_event:site_idx for site_idx, num_event in site.migration_paths['Plane']}
+
+            grid_crystal[idx] = site
+
+        return grid_crystal
+
+    def save(self,template_path):
+
+        template_path = Path(template_path)
+        template_path.mkdir(parents=True, exist_ok=True)
+        file_path = template_path / template_filename(self.structure_type,self.orientation,self.supercell,self.radius_neighbors)
+
+        with open(file_path, 'wb') as file:
+            pickle.dump(self, file)
+
+
+def reduced_supercell(crystal_size,lattice_constant):
+    # Supercell size in units of the lattice constant - Same for every material with the same supercell
+    return tuple(round(float(size / lattice_constant),3) for size in crystal_size)
+
+def template_filename(structure_type,orientation,supercell,radius_neighbors):
+    return (f"{structure_type}_{orientation}_" + 'x'.join(f"{size:.3f}" for size in supercell)
+            + f"_r{radius_neighbors:.3f}.pkl")
+
+def load_template(template_path,structure_type,orientation,supercell,radius_neighbors):
+
+    file_path = Path(template_path) / template_filename(structure_type,orientation,supercell,radius_neighbors)
+
+    if not file_path.exists():
+        return None
+
+    with open(file_path, 'rb') as file:
+        return pickle.load(file)
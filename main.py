@@ -42,12 +42,14 @@ import time
 
 save_data = False
 lammps_file = False
+print_superbasins = True # Superbasin messages in stdout
 
 # def main():
 
 for n_sim in range(0,1):
     
     System_state,rng,paths,Results = initialization(n_sim,save_data,lammps_file)
+    System_state.superbasin_telemetry.verbose = print_superbasins
     
     System_state.add_time()
         
@@ -63,8 +65,6 @@ for n_sim in range(0,1):
     if System_state.experiment == 'deposition':   
 
         nothing_happen = 0
-        # list_time_step = []
-        list_sites_occu = []
         thickness_limit = 10 # (1 nm)
         System_state.measurements_crystal()
         i = 0
@@ -73,26 +73,27 @@ for n_sim in range(0,1):
       
             System_state,KMC_time_step = KMC(System_state,rng)
             
-            list_sites_occu.append(len(System_state.sites_occupied))
-            
-            if np.mean(list_sites_occu[-System_state.n_search_superbasin:]) == len(System_state.sites_occupied):
-            # if np.mean(list_time_step[-System_state.n_search_superbasin:]) <= System_state.time_step_limits:
-                nothing_happen +=1    
-            else:
-                nothing_happen = 0
-                if System_state.E_min - System_state.energy_step > 0:
-                    System_state.E_min -= System_state.energy_step
+            # AS-KMC: the rates are rescaled in KMC() instead of building superbasins
+            if not System_state.rate_rescaling.active:
+                # Particles moving back and forth during the last n_search_superbasin events
+                if System_state.flicker_detector.flickering():
+                    nothing_happen +=1    
                 else:
-                    System_state.E_min = 0
+                    nothing_happen = 0
+                    if System_state.E_min - System_state.energy_step > 0:
+                        System_state.E_min -= System_state.energy_step
+                    else:
+                        System_state.E_min = 0
             
-            if System_state.n_search_superbasin == nothing_happen:
-                search_superbasin(System_state)
-            elif nothing_happen> 0 and nothing_happen % System_state.n_search_superbasin == 0:
-                if System_state.E_min_lim_superbasin >= System_state.E_min + System_state.energy_step:
-                    System_state.E_min += System_state.energy_step
-                else:
-                    System_state.E_min = System_state.E_min_lim_superbasin
-                search_superbasin(System_state)
+                # Superbasins only for the particles at the flickering sites
+                if nothing_happen == 1:
+                    search_superbasin(System_state,System_state.flicker_detector.flickering_sites())
+                elif nothing_happen > 1 and (nothing_happen - 1) % System_state.n_search_superbasin == 0:
+                    if System_state.E_min_lim_superbasin >= System_state.E_min + System_state.energy_step:
+                        System_state.E_min += System_state.energy_step
+                    else:
+                        System_state.E_min = System_state.E_min_lim_superbasin
+                    search_superbasin(System_state,System_state.flicker_detector.flickering_sites())
                 
 
                 
@@ -103,12 +104,18 @@ for n_sim in range(0,1):
                 
                 j+=1
                 System_state.measurements_crystal()
+                # Compact the layers below the growth front
+                System_state.active_window.update(System_state)
                 print(str(System_state.thickness/thickness_limit * 100) + ' %','| Thickness: ', System_state.thickness, '| Total time: ',System_state.list_time[-1])
                 end_time = time.time()
                 if save_data:
                     Results.measurements_crystal(System_state.list_time[-1],System_state.mass_gained,System_state.fraction_sites_occupied,
                                                   System_state.thickness,np.mean(np.array(System_state.terraces)[np.array(System_state.terraces) > 0]),np.std(np.array(System_state.terraces)[np.array(System_state.terraces) > 0]),max(System_state.terraces),
                                                   System_state.surf_roughness_RMS,end_time-starting_time)
+                
+                # Superbasin metrics since the last snapshot
+                metrics = System_state.superbasin_telemetry.snapshot(j,System_state.list_time[-1],System_state.superbasin_cache)
+                if save_data: System_state.superbasin_telemetry.write(paths['results'],metrics)
     
                 System_state.plot_crystal(45,45,paths['data'],j)
                 
@@ -173,7 +180,7 @@ for n_sim in range(0,1):
     System_state.plot_crystal(45,45)
     
     # Variables to save
-    variables = {'System_state' : System_state}
+    variables = {'System_state' : System_state, 'rng' : rng}
     filename = 'variables'
     if save_data: save_variables(paths['program'],variables,filename)
 
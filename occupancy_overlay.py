@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Occupancy overlay: hypothetical configurations on top of grid_crystal
+"""
+import copy
+
+
+# =============================================================================
+# Occupancy overlay - Hypothetical configurations on top of grid_crystal
+#
+# The superbasin exploration moves one particle through the basin to calculate
+# the events of each state. Instead of migrating the particle in grid_crystal
+# (System_state.processes), we copy only the sites affected by the virtual
+# migrations (copy-on-write) and recalculate their support and events here:
+#     - overlay[idx] returns the local copy of the site if it was modified,
+#       otherwise the site of grid_crystal
+#     - The Site methods (supported_by, available_migrations) work with the
+#       overlay as if it were grid_crystal
+#     - The copies share the caches of the original sites
+#
+# grid_crystal, sites_occupied and the rest of System_state are not modified
+# =============================================================================
+
+class Occupancy_Overlay():
+
+    def __init__(self,System_state):
+
+        self.grid_crystal = System_state.grid_crystal
+        self.chemical_specie = System_state.chemical_specie
+        self.wulff_facets = System_state.wulff_facets
+        self.dir_edge_facets = System_state.dir_edge_facets
+        self.domain_height = System_state.domain_height
+        self.facets_type = System_state.facets_type
+        self.temperature = System_state.temperature
+
+        self.sites = {} # Local copies of the modified sites
+
+    def __getitem__(self,idx):
+        return self.sites[idx] if idx in self.sites else self.grid_crystal[idx]
+
+    def __contains__(self,idx):
+        return idx in self.grid_crystal
+
+    def site(self,idx):
+
+        # Copy the site the first time we modify it
+        if idx not in self.sites:
+            self.sites[idx] = copy.copy(self.grid_crystal[idx])
+        return self.sites[idx]
+
+    def move_specie(self,idx_origin,idx_destination):
+
+        if idx_origin == idx_destination: return
+
+        self.site(idx_origin).chemical_specie = 'Empty'
+        self.site(idx_destination).chemical_specie = self.chemical_specie
+
+        # Support of the sites around the origin and the destination
+        update_supp_av = {idx_origin,idx_destination}
+        update_supp_av.update(self.grid_crystal[idx_origin].nearest_neighbors_idx)
+        update_supp_av.update(self.grid_crystal[idx_destination].nearest_neighbors_idx)
+
+        for idx in update_supp_av:
+            self.site(idx).supported_by(self,self.wulff_facets,self.dir_edge_facets,
+                                        self.chemical_specie,self.domain_height)
+
+    def site_events(self,idx):
+
+        # Events of the particle at idx in the hypothetical configuration
+        site = self.site(idx)
+        site.available_migrations(self,idx,self.facets_type)
+        site.transition_rates(self.temperature)
+
+        return site.site_events
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Random buffer: blocks of random numbers for the KMC loop
+"""
+import numpy as np
+
+
+# =============================================================================
+# Random buffer - Blocks of random numbers for the KMC loop
+#     - random() and exponential() take the numbers from blocks of block_size
+#       uniforms / standard exponentials drawn at once from the same Generator.
+#       A call to a numpy Generator has an overhead much larger than reading a
+#       number from an array
+#     - The rest of the methods (integers, binomial, gamma...) go directly to the
+#       Generator, so Random_Buffer can replace it everywhere
+#     - Checkpoint/restart: we save the state of the bit generator when each block
+#       was drawn, the current state and the position in the blocks. When it is
+#       loaded, the blocks are drawn again from their states, so the sequence is
+#       bit-reproducible and the blocks are not saved
+# =============================================================================
+
+class Random_Buffer():
+
+    def __init__(self,generator,block_size = 4096):
+
+        self.generator = generator
+        self.block_size = block_size
+        self.uniform_state = None
+        self.exponential_state = None
+        self.refill_uniform()
+        self.refill_exponential()
+
+    def refill_uniform(self):
+
+        self.uniform_state = self.generator.bit_generator.state
+        self.uniforms = self.generator.random(self.block_size)
+        self.uniform_position = 0
+
+    def refill_exponential(self):
+
+        self.exponential_state = self.generator.bit_generator.state
+        self.exponentials = self.generator.standard_exponential(self.block_size)
+        self.exponential_position = 0
+
+    def random(self,size = None):
+
+        if size is None:
+            if self.uniform_position == self.block_size:
+                self.refill_uniform()
+            value = self.uniforms[self.uniform_position]
+            self.uniform_position += 1
+            return value
+
+        # Several numbers: from the current block and the next ones
+        values = np.empty(size)
+        i = 0
+        while i < size:
+            if self.uniform_position == self.block_size:
+                self.refill_uniform()
+            n = min(size - i,self.block_size - self.uniform_position)
+            values[i:i + n] = self.uniforms[self.uniform_position:self.uniform_position + n]
+            self.uniform_position += n
+            i += n
+        return values
+
+    def exponential(self):
+
+        if self.exponential_position == self.block_size:
+            self.refill_exponential()
+        value = self.exponentials[self.exponential_position]
+        self.exponential_position += 1
+        return value
+
+    def __getattr__(self,name):
+
+        # Only called for attributes that are not in Random_Buffer
+        if name == 'generator': raise AttributeError(name)
+        return getattr(self.generator,name)
+
+# =============================================================================
+#     Checkpoint/restart
+# =============================================================================
+    def __getstate__(self):
+
+        state = self.__dict__.copy()
+        state['generator_state'] = self.generator.bit_generator.state
+        state['bit_generator'] = type(self.generator.bit_generator).__name__
+        for key in ('generator','uniforms','exponentials'):
+            del state[key]
+        return state
+
+    def __setstate__(self,state):
+
+        generator_state = state.pop('generator_state')
+        bit_generator = getattr(np.random,state.pop('bit_generator'))()
+        self.__dict__.update(state)
+        self.generator = np.random.Generator(bit_generator)
+
+        # Draw the blocks again from the states at the time they were drawn
+        self.generator.bit_generator.state = self.uniform_state
+        self.uniforms = self.generator.random(self.block_size)
+        self.generator.bit_generator.state = self.exponential_state
+        self.exponentials = self.generator.standard_exponential(self.block_size)
+        self.generator.bit_generator.state = generator_state
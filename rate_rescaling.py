@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Rate rescaling (AS-KMC): alternative to the superbasins
+"""
+from itertools import chain
+
+
+# =============================================================================
+# Rate rescaling (AS-KMC) - Alternative to the superbasins (absorbing Markov chains)
+# Chatterjee, A., & Voter, A. F. (2010). Accurate acceleration of kinetic Monte Carlo
+# simulations through the modification of rate constants.
+# The Journal of Chemical Physics, 132(19), 194101. https://doi.org/10.1063/1.3409606
+#
+#     - Process: events with the same activation energy (rounded to energy_resolution)
+#     - A process executed n_f times without an escape is quasi-equilibrated and
+#       its rates are divided by alpha (scaling factor). Every n_f more executions
+#       they are divided by alpha again
+#     - Escape: an event slower than all the scaled processes (higher activation
+#       energy) or a migration from a superbasin. The system left the basin and
+#       all the rates are restored
+#     - Bounded error: the scaled rates are never smaller than 1/delta times the
+#       fastest rate of the events that are not scaled (deposition included), so the
+#       scaled processes are still quasi-equilibrated with respect to the escapes
+#
+# The rates of the sites (site_events, cache_TR) are not modified: the scaling is
+# applied when the catalog of events is built in KMC(), so changing the factors
+# does not require recalculating the events of any site
+# =============================================================================
+
+class Rate_Rescaling():
+
+    def __init__(self,active = False,n_f = 20,alpha = 2,delta = 0.01,energy_resolution = 1e-3):
+
+        self.active = active
+        self.n_f = n_f
+        self.alpha = alpha
+        self.delta = delta
+        self.energy_resolution = energy_resolution
+        self.scaling = {} # Process -> scaling factor (< 1)
+        self.counts = {} # Process -> executions since the last scaling
+
+    def process(self,E):
+        return round(E / self.energy_resolution)
+
+    def reset(self):
+
+        self.scaling = {}
+        self.counts = {}
+
+# =============================================================================
+#     Catalog of events with the scaled rates
+#      - TR_catalog[0] = TR (scaled)
+#      - TR_catalog[1] = Arrival site
+#      - TR_catalog[2] = Event label
+#      - TR_catalog[3] = Starting site
+# =============================================================================
+    def rescaled_catalog(self,System_state):
+
+        grid_crystal = System_state.grid_crystal
+        superbasin_dict = System_state.superbasin_dict
+        deposition_event = System_state.num_event - 1
+        scaling = self.scaling
+
+        # Fastest event that is not scaled
+        slow_rate = 0
+        TR_catalog = []
+        for idx in chain(System_state.active_sites,System_state.adsorption_sites):
+
+            if idx in System_state.first_passage.walkers: continue
+
+            if idx in superbasin_dict:
+                for item in superbasin_dict[idx].site_events_absorbing:
+                    TR_catalog.append((item[0],item[1],item[2],idx,None))
+                    slow_rate = max(slow_rate,item[0])
+                continue
+
+            for item in grid_crystal[idx].site_events:
+                process = self.process(item[3]) if item[2] != deposition_event else None
+                if process not in scaling:
+                    process = None
+                    slow_rate = max(slow_rate,item[0])
+                TR_catalog.append((item[0],item[1],item[2],idx,process))
+
+        min_rate = slow_rate / self.delta
+        return [(TR * min(1,max(scaling[process],min_rate / TR)),idx_dest,label,idx) if process is not None
+                else (TR,idx_dest,label,idx)
+                for TR,idx_dest,label,idx,process in TR_catalog]
+
+# =============================================================================
+#     Executed events: quasi-equilibrated processes and escapes
+# =============================================================================
+    def record_event(self,chosen_event,System_state):
+
+        idx_origin = chosen_event[-1]
+
+        # Migration from a superbasin: the particle escaped
+        if idx_origin in System_state.superbasin_dict:
+            self.reset()
+            return
+
+        # Deposition is never scaled
+        if chosen_event[2] == System_state.num_event - 1: return
+
+        E = next(event[3] for event in System_state.grid_crystal[idx_origin].site_events
+                 if event[1] == chosen_event[1] and event[2] == chosen_event[2])
+        process = self.process(E)
+
+        if self.scaling and process not in self.scaling and process > max(self.scaling):
+            self.reset()
+
+        self.counts[process] = self.counts.get(process,0) + 1
+        if self.counts[process] >= self.n_f:
+            self.scaling[process] = self.scaling.get(process,1) / self.alpha
+            self.counts[process] = 0
@@ -5,7 +5,11 @@ Created on Wed Aug 28 13:31:56 2024
 @author: samuel.delgado
 """
 import numpy as np
+import time
+from collections import OrderedDict
 from scipy import constants
+from scipy.sparse import coo_matrix, diags
+from occupancy_overlay import Occupancy_Overlay
 
 
 # =============================================================================
@@ -20,40 +24,68 @@ from scipy import constants
 
 class Superbasin():
     
-    def __init__(self,idx, System_state,E_min,sites_occupied):
+    def __init__(self,idx, System_state,E_min):
         
         self.particle_idx = idx
         self.E_min = E_min
-        # Make a deep copy of System_state to avoid modifying the original object
         self.epsilon_min_decrement = 0.1  # Step to decrease E_min per retr       
         self.retry_limit = max(round(E_min / self.epsilon_min_decrement),2)  # Maximum retry attempts
+        
+        # Telemetry
+        self.verbose = System_state.superbasin_telemetry.verbose # Print the conditioning number
+        self.cached = False
+        self.cond_number = None
+        self.construction_time = 0 # Exploration of the states (s)
+        self.solve_time = 0 # Transition matrix, Markov matrix and absorption probabilities (s)
+        start_time = time.perf_counter()
+
+        # Superbasin solved before for the same local configuration -> Translate it
+        superbasin_cache = System_state.superbasin_cache
+        signature,local_sites = superbasin_cache.local_configuration(idx,System_state,E_min)
+        if superbasin_cache.load(self,signature,local_sites,System_state.num_event):
+            self.cached = True
+            self.construction_time = time.perf_counter() - start_time
+            return
 
         # Core workflow
-        self.trans_absorbing_states(idx,System_state,sites_occupied)
+        self.solve(idx,System_state)
+        superbasin_cache.store(self,signature,local_sites,System_state.grid_crystal)
+        
+    def solve(self,idx,System_state):
+        
+        start_time = time.perf_counter()
+        self.trans_absorbing_states(idx,System_state)
+        self.construction_time = time.perf_counter() - start_time
+        
         if not self.absorbing_states or not self.transient_states:
             self.valid = False  # Mark the object as invalid
             return
         
         self.valid = True  # Mark the object as valid if absorbing states exist
         
-        
+        start_time = time.perf_counter()
         self.transition_matrix()
         self.markov_matrix()
         
         if not self.absorption_probability_matrix():
             self.valid = False  # Mark as invalid if poor conditioning is detected
+            self.solve_time = time.perf_counter() - start_time
             return
         
-        self.calculate_transition_rates_absorbing_states(System_state.num_event)
+        self.calculate_transition_rates_absorbing_states(System_state.num_event,System_state.temperature)
+        self.solve_time = time.perf_counter() - start_time
         self.calculate_superbasin_environment(System_state.grid_crystal)
 
    
-    def trans_absorbing_states(self,start_idx,System_state,sites_occupied):
+    def trans_absorbing_states(self,start_idx,System_state):
         
         stack = [start_idx]
         visited = set()
 
-        grid_crystal = System_state.grid_crystal
+        # Virtual migrations on an occupancy overlay - grid_crystal is not modified
+        overlay = Occupancy_Overlay(System_state)
+        particle_idx = start_idx
+        
         self.absorbing_states = []
         self.transient_states_transitions = []
         self.absorbing_states_transitions = []
@@ -63,10 +95,14 @@ class Superbasin():
             idx = stack.pop()
 
             if idx not in visited:
-                site = grid_crystal[idx]
+                # Move the particle to idx to calculate the activation energies
+                overlay.move_specie(particle_idx,idx)
+                particle_idx = idx
+                site_events = overlay.site_events(idx)
+                
                 is_absorbing = True # Assume that it is an absorbing state
                 
-                for transition in site.site_events:
+                for transition in site_events:
                     transition_with_idx = transition + [idx]
                     if transition[3] < self.E_min:
 
@@ -80,7 +116,7 @@ class Superbasin():
                     self.absorbing_states.append(idx)
 
                 else:
-                    for transition in site.site_events:
+                    for transition in site_events:
                         # Visit all the transitions from a transient state, even those
                         # with larger Act. Energy than E_min
                         if transition[1] not in visited:
@@ -88,13 +124,6 @@ class Superbasin():
                 
                 # Control of the states visited
                 visited.add(idx)
-                                
-            # Virtual migrations to calculate activation energies
-            if stack:
-                System_state.processes((transition[0], stack[-1], transition[2], idx))
-                
-    
-        System_state.processes((transition[0], start_idx, transition[2], idx)) 
 
         # Construct the transitions to the absorbing states
         for absorbing_state in self.absorbing_states: 
@@ -111,139 +140,91 @@ class Superbasin():
         self.transient_states = list({transition[-1] for transition in self.transient_states_transitions})
 
         self.superbasin_idx = self.absorbing_states + self.transient_states 
-        
-        # Check that grid_crystal is in the original state
-        self.verify_grid_crystal(System_state,sites_occupied) 
    
     def transition_matrix(self):
         
+        # Transitions as arrays of (origin, destination, rate) using the position of 
+        # each state in superbasin_idx (absorbing states first, then transient states)
         transitions = self.absorbing_states_transitions + self.transient_states_transitions
-        
-        # Create a dictionary for quick lookup
-        transition_dict = {(transition[1], transition[-1]): transition[0] 
-                           for transition in transitions}
-        # Initialize the transition matrix with zeros
         n = len(self.superbasin_idx)
-        A_transitions = np.zeros((n, n))
+        n_absorbing = len(self.absorbing_states)
         
-        state_origins = self.superbasin_idx
-        state_destinations = self.superbasin_idx
+        state_index = {state:i for i,state in enumerate(self.superbasin_idx)}
+        self.transitions_origin = np.array([state_index[transition[-1]] for transition in transitions], dtype = int)
+        self.transitions_destination = np.array([state_index[transition[1]] for transition in transitions], dtype = int)
+        self.transitions_rate = np.array([transition[0] for transition in transitions], dtype = float)
         
-        # Fill the diagonal elements
-        for i, state_origin in enumerate(state_origins):
-            
-            if state_origin in self.absorbing_states:
-                A_transitions[i, i] = 0
-            else:
-                tau = sum(transition[0] for transition in transitions if 
-                          state_origin == transition[-1])
-                A_transitions[i, i] = tau
-                
-        # Fill the off-diagonal elements
-        for i, state_origin in enumerate(state_origins):
-            for j, state_destination in enumerate(state_destinations):
-                if i != j:
-                    rate = -transition_dict.get((state_origin, state_destination), 0)
-                    A_transitions[i, j] = max(rate, 0)
-                    
-        self.A_transitions = A_transitions
+        # Diagonal: Aii = 0 for the absorbing border states and the sum of the 
+        # transition rates from the state for the transient states
+        # Off-diagonal elements are max(-rate, 0) = 0
+        tau = np.bincount(self.transitions_origin, weights = self.transitions_rate, minlength = n)
+        tau[:n_absorbing] = 0
         
-    def transition_matrix_2(self):
-        self.A_transitions_2 = []
-        transitions = self.absorbing_states_transitions + self.transient_states_transitions
-
-        # Create a dictionary for quick lookup
-        transition_dict = {}
-        for transition in transitions:
-            key = (transition[1], transition[-1])
-            transition_dict[key] = transition[0]
-
-        for i,state_origin in enumerate(self.superbasin_idx):
-            row = [] # Each row include the transition from each state_origin
-            for j,state_destination in enumerate(self.superbasin_idx):
-                
-                # Aii = 0 for the absorbing border states
-                
-                if i == j:
-                    if state_origin in self.absorbing_states:
-                        row.append(0)
-                    else:
-                        # For the diagonal in transient states: sum runs over all k superbasin states
-                        tau = sum(transition[0] for transition in transitions if
-                                  state_origin == transition [-1])
-                        row.append(tau)
-                        
-                else:
-                    
-                    rate = -transition_dict.get((state_origin, state_destination), 0)
-                    rate = rate if rate > 0 else 0
-                    row.append(rate)
-                    
-            self.A_transitions_2.append(row)
-        self.A_transitions_2 = np.array(self.A_transitions_2)
-    
+        self.A_transitions = diags(tau).tocsr()
      
     def markov_matrix(self):
         
-        self.M_Markov = []
-        transitions = self.absorbing_states_transitions + self.transient_states_transitions
-
-        for i,state_origin in enumerate(self.superbasin_idx):
-            row = [0] * len(self.superbasin_idx)  # Initialize row with zeros
-            
-            if state_origin in self.absorbing_states:
-                row[i] = 1 # Absorbing states have a self-transition probability of 1
-                
-            else:
-                for transition in transitions:
-                    origin, destination, rate = transition[-1], transition[1], transition[0]
-                    if state_origin == origin:
-                        j = self.superbasin_idx.index(destination)
-                        row[j] = rate / self.A_transitions[i][i]                  
-                    
-            self.M_Markov.append(row)
-        self.M_Markov = np.array(self.M_Markov)
-      
+        n = len(self.superbasin_idx)
+        n_absorbing = len(self.absorbing_states)
+        tau = self.A_transitions.diagonal()
+        
+        # Absorbing states have a self-transition probability of 1
+        # Transient states: probability of each transition = rate / sum of rates from the state
+        transient = self.transitions_origin >= n_absorbing
+        origin = self.transitions_origin[transient]
+        
+        rows = np.r_[np.arange(n_absorbing), origin]
+        cols = np.r_[np.arange(n_absorbing), self.transitions_destination[transient]]
+        data = np.r_[np.ones(n_absorbing), self.transitions_rate[transient] / tau[origin]]
+        
+        self.M_Markov = coo_matrix((data,(rows,cols)), shape = (n,n)).tocsr()
          
     def absorption_probability_matrix(self):
         
+        # Sparse LU factorization of I - T_transient. Each state has only a few exits, 
+        # so the matrix is mostly zeros. We solve directly for:
+        #     - B_absorption: (I - T) B = R  -> Probability of absorption in each absorbing state
+        #     - FPT: (I - T) FPT = 1 -> Row sums of the fundamental matrix N = (I - T)^-1
+        from scipy.sparse import csc_matrix, identity, issparse
+        from scipy.sparse.linalg import splu, onenormest, LinearOperator
+        
         self.B_absorption = []
         
         n_transient = len(self.transient_states)
         n_absorbing = len(self.absorbing_states)
         
-
-        T_transient = self.M_Markov[n_absorbing:,n_absorbing:]# Transient matrix
+        T_transient = self.M_Markov[n_absorbing:,n_absorbing:] # Transient matrix
         R_recurrent = self.M_Markov[n_absorbing:,:n_absorbing] # Recurrent matrix
+        if issparse(R_recurrent): R_recurrent = R_recurrent.toarray()
         
-        # Calculate the fundamental matrix N
-        I = np.eye(n_transient)
-        I_reg = I - T_transient
-        
-        # Check for poor conditioning 
-        cond_number = np.linalg.cond(I_reg)
-        print('Conditioning number: ', cond_number)
-        if cond_number > 1e10: # In this case, the matrix is almost singular --> Large errors
-            print(f"Matrix is poorly conditioned (cond = {cond_number}). Adjust regularization or inspect T_transient.")
-            return False
+        I_T = csc_matrix(identity(n_transient) - T_transient)
         
         # Check for NaN or infinity values
-        if np.any(np.isnan(I_reg)) or np.any(np.isinf(I_reg)):
-            raise ValueError("I_reg = I - T_transient contains NaN or infinity values.")
-            return False
+        if not np.all(np.isfinite(I_T.data)):
+            raise ValueError("I - T_transient contains NaN or infinity values.")
         
-            # Regularize the matrix
-        epsilon = 1e-10
-        I_reg += epsilon * np.eye(I_reg.shape[0])
-        # Calculate the pseudo-inverse with error handling
         try:
-            self.N = np.linalg.pinv(I - T_transient) # Pseudo-inverse
-        except np.linalg.LinAlgError:
-            print("SVD did not converge")
+            lu = splu(I_T)
+        except RuntimeError: # Exactly singular
+            self.cond_number = np.inf
+            if self.verbose: print("Matrix I - T_transient is singular")
             return False
         
-        # Calculate the absorption probabilities matrix B
-        self.B_absorption = np.dot(self.N, R_recurrent) 
+        # Check for poor conditioning - 1-norm estimate: ||A||_1 * ||A^-1||_1 
+        # ||A^-1||_1 is estimated with a few solves using the LU factors 
+        inverse_I_T = LinearOperator((n_transient,n_transient), matvec = lu.solve, 
+                                     rmatvec = lambda x: lu.solve(x, trans = 'T'), dtype = float)
+        cond_number = abs(I_T).sum(axis=0).max() * onenormest(inverse_I_T)
+        self.cond_number = cond_number
+        if self.verbose: print('Conditioning number: ', cond_number)
+        if cond_number > 1e10: # In this case, the matrix is almost singular --> Large errors
+            if self.verbose: print(f"Matrix is poorly conditioned (cond = {cond_number}). Adjust regularization or inspect T_transient.")
+            return False
+        
+        # Calculate the absorption probabilities matrix B and the first passage time
+        solution = lu.solve(np.hstack((R_recurrent, np.ones((n_transient,1)))))
+        self.B_absorption = solution[:,:n_absorbing]
+        self.FPT = solution[:,n_absorbing]
        
         return True
         
@@ -252,7 +233,7 @@ class Superbasin():
         
         # Mean time to absorbing state j from the transient state i
         # (first passage time - FPT)
-        FPT = np.sum(self.N, axis=1)
+        FPT = self.FPT.copy()
         # Calculate transition_rates
         
         # Avoid division by zero or very small values
@@ -288,22 +269,134 @@ class Superbasin():
             
         self.superbasin_environment = set(list(self.superbasin_environment) + self.superbasin_idx)
         
-        self.superbasin_environment.discard('Substrate') 
+        self.superbasin_environment.discard('Substrate')
 
-    # Verify that we leave grid_crystal in the original state
-    def verify_grid_crystal(self,System_state,sites_occupied):       
-        
-        for site in sites_occupied:
-            # It should be occupied, but it is not
-            if System_state.grid_crystal[site].chemical_specie != System_state.chemical_specie:
-                # Select deposition event
-                # event = System_state.grid_crystal[site].site_events[0]
-                # Remove the site from sites_occupied
-                # System_state.sites_occupied.remove(event[1])
-                System_state.sites_occupied.remove(site)
-                # Introduce the particle
-                # System_state.processes((event[0], event[1], event[2], event[1])) 
-                System_state.processes((0, site, System_state.num_event-1, site)) 
 
+# =============================================================================
+# Cache of solved superbasins
+#     Flickering particles on the same terrace or step motif produce the same
+#     superbasin at different positions. The cache is keyed by a translation-invariant
+#     signature of the local configuration:
+#         - E_min, temperature and layer of the particle
+#         - Sites within `depth` jumps of the particle, ordered by a BFS that follows
+#           the migration labels (same order for equivalent positions), with their
+#           occupancy and neighbors
+#     The superbasins are stored with the states as positions in this BFS order, so a
+#     new superbasin on a known motif is obtained by translation
+#
+#     A superbasin is only stored if the sites that affect its events (states and
+#     two shells of neighbors) are within `depth` jumps of the particle
+#     Least recently used (LRU) entries are removed when the cache is full
+# =============================================================================
+
+class Superbasin_Cache():
+    
+    def __init__(self,max_size = 1000,depth = 4):
+        
+        self.max_size = max_size
+        self.depth = depth
+        self.superbasins = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        
+    def local_configuration(self,idx,System_state,E_min):
+        
+        grid_crystal = System_state.grid_crystal
+        local_sites = [idx]
+        position = {idx:0}
+        site_paths = {}
+        
+        frontier = [idx]
+        for depth in range(self.depth + 1):
+            next_frontier = []
+            for site_idx in frontier:
+                migration_paths = grid_crystal[site_idx].migration_paths
+                site_paths[site_idx] = sorted(migration_paths['Plane'] + migration_paths['Up'] + migration_paths['Down'], 
+                                              key = lambda path: path[1])
+                if depth == self.depth: continue
+                
+                for neighbor,num_event in site_paths[site_idx]:
+                    if neighbor not in position:
+                        position[neighbor] = len(local_sites)
+                        local_sites.append(neighbor)
+                        next_frontier.append(neighbor)
+            frontier = next_frontier
+            
+        # Occupancy and neighbors (migration label, position in local_sites) of each site
+        # Near the periodic boundaries the neighbors are not always the same, so we
+        # include all of them, not only the ones we used to reach each site
+        configuration = tuple(
+            (grid_crystal[site_idx].chemical_specie != 'Empty',
+             tuple((num_event,position.get(neighbor,-1)) for neighbor,num_event in site_paths[site_idx]))
+            for site_idx in local_sites
+            )
+            
+        signature = (round(E_min,6),System_state.temperature,System_state.layer_index(idx),configuration)
+        
+        return signature,local_sites
+    
+    def load(self,superbasin,signature,local_sites,num_event):
+        
+        if signature not in self.superbasins:
+            self.misses += 1
+            return False
+        
+        self.hits += 1
+        self.superbasins.move_to_end(signature)
+        cached = self.superbasins[signature]
+
+        superbasin.valid = cached['valid']
+        superbasin.cond_number = cached.get('cond_number')
+        superbasin.absorbing_states = [local_sites[i] for i in cached['absorbing_states']]
+        superbasin.transient_states = [local_sites[i] for i in cached['transient_states']]
+        superbasin.superbasin_idx = superbasin.absorbing_states + superbasin.transient_states
+        
+        if superbasin.valid:
+            superbasin.transition_rates = cached['transition_rates'].copy()
+            superbasin.EAct = cached['EAct'].copy()
+            superbasin.superbasin_environment = ({local_sites[i] for i in cached['superbasin_environment']} 
+                                                 | set(cached['environment_labels']))
+            superbasin.site_events_absorbing = [
+                (transition_r, absorbing_state, num_event - 2, EAct, superbasin.particle_idx)
+                for transition_r, absorbing_state, EAct 
+                in zip(superbasin.transition_rates, superbasin.absorbing_states, superbasin.EAct)
+                ]
+        
+        return True
+    
+    def store(self,superbasin,signature,local_sites,grid_crystal):
         
-      
\ No newline at end of file
+        position = {site_idx:i for i,site_idx in enumerate(local_sites)}
+        
+        # Sites that affect the events of the superbasin: states and two shells of neighbors
+        region = set(superbasin.superbasin_idx)
+        for _ in range(2):
+            region.update([neighbor for site_idx in region for neighbor in grid_crystal[site_idx].nearest_neighbors_idx])
+        if not region <= position.keys():
+            return
+        
+        cached = {'valid':superbasin.valid,
+                  'cond_number':superbasin.cond_number,
+                  'absorbing_states':[position[site_idx] for site_idx in superbasin.absorbing_states],
+                  'transient_states':[position[site_idx] for site_idx in superbasin.transient_states]}
+        
+        if superbasin.valid:
+            cached['transition_rates'] = superbasin.transition_rates.copy()
+            cached['EAct'] = superbasin.EAct.copy()
+            cached['superbasin_environment'] = [position[site_idx] for site_idx in superbasin.superbasin_environment 
+                                                if site_idx in position]
+            cached['environment_labels'] = [site_idx for site_idx in superbasin.superbasin_environment 
+                                            if site_idx not in position]
+        
+        self.superbasins[signature] = cached
+        if len(self.superbasins) > self.max_size:
+            self.superbasins.popitem(last = False)
+            
+    def update(self,entries):
+        
+        # Entries solved in other processes
+        for signature,cached in entries.items():
+            self.superbasins[signature] = cached
+            self.superbasins.move_to_end(signature)
+        while len(self.superbasins) > self.max_size:
+            self.superbasins.popitem(last = False)
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Superbasin scheduler: wall-clock budget, priority of the candidates and speedup
+"""
+import heapq
+import math
+
+
+# =============================================================================
+# Superbasin scheduler
+#     - Budget: each search_superbasin() has a wall-clock budget (time_budget).
+#       The candidates are built in order of priority until the deadline, and the
+#       superbasins built before the deadline are kept
+#     - Priority: expected time gain of building a superbasin for a particle
+#           flicker count * (rate of the events below E_min / rate of the other events)
+#       A particle that flickers a lot and rarely escapes gains the most. The flicker
+#       count is the number of recent events from/to the site (Flicker_Detector)
+#     - Speedup: when a superbasin is dismantled we calculate the simulated-time
+#       speedup it delivered. With the superbasin, the total rate is reduced by
+#       delta_rate = rate of the events of the particle - rate of the absorbing events,
+#       so the time step is 1/R instead of 1/(R + delta_rate). With the average R
+#       during its lifetime (kmc steps / simulated time):
+#           speedup = 1 + delta_rate * lifetime / kmc steps
+#       The speedup is recorded in the superbasin telemetry
+# =============================================================================
+
+class Superbasin_Scheduler():
+
+    def __init__(self,time_budget = 300):
+
+        self.time_budget = time_budget # (s)
+
+    def expected_gain(self,idx,System_state):
+
+        fast_rate = 0
+        escape_rate = 0
+        for event in System_state.grid_crystal[idx].site_events:
+            if event[3] <= System_state.E_min:
+                fast_rate += event[0]
+            else:
+                escape_rate += event[0]
+
+        flicker_count = System_state.flicker_detector.site_count.get(idx,0) + 1
+        return flicker_count * fast_rate / escape_rate if escape_rate > 0 else math.inf
+
+    def prioritize(self,candidates,System_state):
+
+        # Priority queue: largest expected time gain first (ties: order of candidates)
+        queue = [(-self.expected_gain(idx,System_state),i,idx) for i,idx in enumerate(candidates)]
+        heapq.heapify(queue)
+        return [heapq.heappop(queue)[2] for _ in range(len(queue))]
+
+# =============================================================================
+#     Simulated-time speedup delivered by each superbasin
+# =============================================================================
+    def superbasin_created(self,superbasin,System_state):
+
+        rate_particle = sum(event[0] for event in System_state.grid_crystal[superbasin.particle_idx].site_events)
+        rate_absorbing = sum(event[0] for event in superbasin.site_events_absorbing)
+
+        superbasin.delta_rate = rate_particle - rate_absorbing
+        superbasin.start_time = System_state.time
+        superbasin.start_kmc_step = System_state.kmc_steps
+
+    def superbasin_dismantled(self,superbasin,System_state):
+
+        lifetime = System_state.time - superbasin.start_time
+        kmc_steps = System_state.kmc_steps - superbasin.start_kmc_step
+        speedup = 1 + superbasin.delta_rate * lifetime / kmc_steps if kmc_steps > 0 else 1
+
+        System_state.superbasin_telemetry.superbasin_dismantled(superbasin,kmc_steps,lifetime,speedup)
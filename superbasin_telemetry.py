@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Superbasin telemetry: metrics to tune the superbasin parameters
+"""
+import json
+import math
+from pathlib import Path
+
+
+# =============================================================================
+# Superbasin telemetry - Data to tune E_min and energy_step
+#     - Each superbasin: number of states, construction (exploration) and solve time,
+#       condition number, if it was translated from the cache, lifetime (KMC steps
+#       and simulated time) until update_superbasin() dismantles it and simulated-time
+#       speedup. A superbasin is dismantled by the first absorbing event, so it is
+#       never used more than once
+#     - Each search: candidates, candidates explored and elapsed time
+#     - Cache of superbasins: hits and misses
+#
+# The records are collected between snapshots and written as one line (JSON) per
+# snapshot in the metrics file. Superbasins alive at the snapshot are written
+# in the snapshot where they are dismantled. Condition numbers that are not finite
+# (singular matrices) are written as strings ('inf', 'nan'): the lines are valid JSON
+# verbose = False suppresses the superbasin messages in stdout
+# =============================================================================
+
+class Superbasin_Telemetry():
+
+    def __init__(self,verbose = True,filename = 'superbasin_metrics.jsonl'):
+
+        self.verbose = verbose
+        self.filename = filename
+        self.superbasins = [] # Records of the superbasins finished since the last snapshot
+        self.searches = [] # Records of the searches since the last snapshot
+        self.cache_hits = 0 # Hits and misses of the cache at the last snapshot
+        self.cache_misses = 0
+
+    def superbasin_built(self,superbasin):
+
+        record = {'particle':[int(i) for i in superbasin.particle_idx],
+                  'E_min':float(superbasin.E_min),
+                  'valid':bool(superbasin.valid),
+                  'cached':superbasin.cached,
+                  'states':len(superbasin.superbasin_idx),
+                  'absorbing_states':len(superbasin.absorbing_states),
+                  'construction_time':superbasin.construction_time,
+                  'solve_time':superbasin.solve_time,
+                  'cond_number':json_number(superbasin.cond_number),
+                  'lifetime_kmc_steps':0,
+                  'lifetime':0.0,
+                  'speedup':1.0}
+
+        # Valid superbasins are recorded when they are dismantled
+        if superbasin.valid:
+            superbasin.telemetry_record = record
+        else:
+            self.superbasins.append(record)
+
+    def superbasin_dismantled(self,superbasin,kmc_steps,lifetime,speedup):
+
+        record = getattr(superbasin,'telemetry_record',None)
+        if record is None: return
+
+        record['lifetime_kmc_steps'] = int(kmc_steps)
+        record['lifetime'] = float(lifetime)
+        record['speedup'] = float(speedup)
+        self.superbasins.append(record)
+
+    def search_finished(self,E_min,candidates,explored,elapsed_time):
+
+        self.searches.append({'E_min':float(E_min),
+                              'candidates':candidates,
+                              'explored':explored,
+                              'elapsed_time':elapsed_time})
+
+    def speedup_summary(self):
+
+        speedups = [record['speedup'] for record in self.superbasins if record['valid']]
+        if not speedups: return None
+        return sum(speedups) / len(speedups), max(speedups)
+
+# =============================================================================
+#     Metrics per snapshot
+# =============================================================================
+    def snapshot(self,i,time,superbasin_cache):
+
+        cache_hits = superbasin_cache.hits - self.cache_hits
+        cache_misses = superbasin_cache.misses - self.cache_misses
+        self.cache_hits = superbasin_cache.hits
+        self.cache_misses = superbasin_cache.misses
+
+        metrics = {'snapshot':i,
+                   'time':float(time),
+                   'searches':self.searches,
+                   'cache_hits':cache_hits,
+                   'cache_misses':cache_misses,
+                   'cache_hit_rate':cache_hits / (cache_hits + cache_misses) if cache_hits + cache_misses > 0 else None,
+                   'superbasins':self.superbasins}
+
+        self.superbasins = []
+        self.searches = []
+
+        return metrics
+
+    def write(self,path,metrics):
+
+        with open(Path(path) / self.filename, 'a') as metrics_file:
+            metrics_file.write(json.dumps(metrics,allow_nan = False) + '\n')
+
+
+def json_number(value):
+    # JSON has no inf or nan
+    if value is None: return None
+    value = float(value)
+    return value if math.isfinite(value) else str(value)
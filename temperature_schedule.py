@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Temperature schedules: ramps and holds of temperature for annealing
+"""
+import numpy as np
+
+
+# =============================================================================
+# Temperature schedule - Annealing with ramps and holds
+#     - points: (time (s), T (K)) from the start of the schedule. T changes linearly
+#       between two points (ramp) or stays constant if both have the same T (hold).
+#       After the last point T is constant
+#     - The ramps are divided in intervals of at most dT (K), with the temperature of the
+#       middle of the interval. Each interval updates the rates of every event, so dT
+#       should not be too small (a 300 -> 800 K ramp: 50 updates with dT = 10 K)
+#     - The rates are constant within each interval, so the KMC is exact for this
+#       piecewise constant temperature:
+#         - The time step is sampled with the rates of the interval. If it goes past
+#           the end of the interval, nothing happens before it (memoryless) and the
+#           clock jumps to the next interval
+#         - At the start of an interval the rates of every event are rescaled by
+#           energy class (Crystal_Lattice.set_temperature)
+#         - The superbasins are dismantled and the new ones are solved at the
+#           temperature of the interval
+#
+# Without points the schedule is inactive: next_update = inf
+# =============================================================================
+
+class Temperature_Schedule():
+
+    def __init__(self,points = None,dT = 10):
+
+        self.points = points
+        self.dT = dT
+        self.intervals = [] # (end time from the start of the schedule, T)
+        self.interval = 0
+        self.start_time = 0
+        self.next_update = np.inf
+
+        if points:
+            for (t0,T0),(t1,T1) in zip(points[:-1],points[1:]):
+                n = max(int(np.ceil(abs(T1 - T0) / dT)),1)
+                for k in range(n):
+                    self.intervals.append((t0 + (t1 - t0) * (k + 1) / n,T0 + (T1 - T0) * (k + 0.5) / n))
+            self.intervals.append((np.inf,points[-1][1]))
+
+    @property
+    def active(self):
+        return bool(self.intervals)
+
+    def start(self,System_state,rng):
+
+        if not self.active: return
+        self.start_time = System_state.time
+        self.interval = -1
+        self.update(System_state,rng)
+
+    def update(self,System_state,rng):
+
+        # Next interval of the schedule
+        self.interval += 1
+        end_time,T = self.intervals[self.interval]
+        self.next_update = self.start_time + end_time
+
+        # First-passage walkers are placed where they are now and protected again with the new rates
+        first_passage = System_state.first_passage
+        sites = first_passage.interrupt(System_state.time,System_state,rng)
+        System_state.set_temperature(T)
+        if first_passage.active:
+            for idx in sites:
+                first_passage.protect(idx,System_state,rng)
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Shared fixtures: small Ag(111) lattices built without access to the Materials Project
+"""
+import sys
+import json
+import types
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0,str(ROOT))
+
+
+class _Surface():
+    def __init__(self,miller_index,surface_energy):
+        self.miller_index = miller_index
+        self.surface_energy = surface_energy
+
+class _MPRester():
+    # Structure and surface energies of Ag (mp-124) as returned by the Materials Project
+    def __init__(self,*args,**kwargs):
+        surfaces = [_Surface((1,1,1),1.0),_Surface((1,0,0),1.1),_Surface((1,1,0),1.2)]
+        search = lambda **kwargs: [types.SimpleNamespace(surfaces = surfaces)]
+        self.materials = types.SimpleNamespace(surface_properties = types.SimpleNamespace(search = search))
+    def __enter__(self):
+        return self
+    def __exit__(self,*args):
+        pass
+    def get_structure_by_material_id(self,id_material):
+        from pymatgen.core import Structure,Lattice
+        return Structure.from_spacegroup('Fm-3m',Lattice.cubic(4.0853),['Ag'],[[0,0,0]])
+
+
+def activation_energies_Ag():
+
+    with open(ROOT / 'activation_energies_deposition.json') as f:
+        data = json.load(f)
+    E = []
+    for element in data['elements']:
+        if element['name'] == 'Ag':
+            for key,value in element.items():
+                if 'activation_energies' in key and 'homoepitaxial' in key:
+                    E += [x for x in value.values() if isinstance(x,(int,float))]
+    # Clustering energies and faster migrations than the reference to keep the tests short
+    E_clustering = [0,0] + [E[-1] * k for k in range(2,14)]
+    return [E[0],E[1],E[2],E[3] * 0.6,E[4],E[5],E[6],E[7],E[8] * 0.6,E[9],E[10],E[-2] * 0.6,E_clustering]
+
+
+@pytest.fixture(scope = 'session')
+def template_path(tmp_path_factory):
+    return str(tmp_path_factory.mktemp('templates'))
+
+@pytest.fixture
+def lattice(monkeypatch,template_path):
+
+    import pymatgen.ext.matproj
+    monkeypatch.setattr(pymatgen.ext.matproj,'MPRester',_MPRester)
+    from crystal_lattice import Crystal_Lattice
+
+    def build(crystal_size = (15,15,12),temperature = 431):
+        crystal_features = ['mp-124',crystal_size,'111',None,None,[(1,1,1),(1,0,0)],None,False,3,'bottom_layer']
+        experimental_conditions = [1,113,temperature,'deposition']
+        System_state = Crystal_Lattice(crystal_features,experimental_conditions,activation_energies_Ag(),False,
+                                       [25,1e-7,0.0,0.05],None,template_path)
+        System_state.limit_kmc_timestep(0.05)
+        return System_state
+
+    return build
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(0)
+
+
+def random_step(System_state,rng,p_remove = 0.3,removable = None):
+
+    # Remove a random particle or introduce one at a random adsorption site
+    update_supp_av = set()
+    update_specie_events = set()
+    occupied = [idx for idx in System_state.sites_occupied if removable is None or removable(idx)]
+    if occupied and rng.random() < p_remove:
+        idx = occupied[rng.integers(len(occupied))]
+        update_specie_events,update_supp_av = System_state.remove_specie_site(idx,update_specie_events,update_supp_av)
+    else:
+        sites = list(System_state.adsorption_sites)
+        idx = sites[rng.integers(len(sites))]
+        update_specie_events,update_supp_av = System_state.introduce_specie_site(idx,update_specie_events,update_supp_av)
+    System_state.update_sites(update_specie_events,update_supp_av)
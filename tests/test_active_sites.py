@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""
+Sites of the KMC catalog (active_sites) against a scan of every occupied site
+"""
+from KMC import KMC
+
+
+def full_scan(System_state):
+
+    # Occupied sites with events or with some empty neighbor (neighbors in both directions)
+    grid_crystal = System_state.grid_crystal
+    neighbors = {idx:set(site.nearest_neighbors_idx) for idx,site in grid_crystal.items()}
+    for idx,site in grid_crystal.items():
+        for neighbor in site.nearest_neighbors_idx:
+            neighbors[neighbor].add(idx)
+
+    return {idx for idx in System_state.sites_occupied
+            if grid_crystal[idx].site_events or any(grid_crystal[neighbor].chemical_specie == 'Empty' for neighbor in neighbors[idx])}
+
+def test_active_sites_match_full_scan(lattice,rng):
+
+    System_state = lattice()
+    for step in range(600):
+        if step % 20 == 0:
+            sites = list(System_state.adsorption_sites)
+            System_state.deposition_sites([sites[i] for i in rng.choice(len(sites),min(15,len(sites)),replace = False)])
+        System_state,_ = KMC(System_state,rng)
+
+        if step % 50 == 0:
+            # A site can stay active after it becomes inert, until its events are calculated again
+            active_sites = set(System_state.active_sites)
+            assert full_scan(System_state) <= active_sites <= set(System_state.sites_occupied)
+            # Catalog of events: the inert sites have no events
+            assert sum(len(System_state.grid_crystal[idx].site_events) for idx in active_sites) == \
+                sum(len(System_state.grid_crystal[idx].site_events) for idx in System_state.sites_occupied)
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+First-passage walkers: clock, exits and placement
+"""
+from KMC import KMC
+from first_passage import First_Passage
+
+
+def test_clock_never_goes_backwards(lattice,rng):
+
+    System_state = lattice((30,30,8))
+    System_state.superbasin_telemetry.verbose = False
+    System_state.first_passage = First_Passage(True)
+
+    for step in range(400):
+        time = System_state.time
+        System_state,time_step = KMC(System_state,rng)
+        assert time_step >= 0 and System_state.time >= time
+        # The walkers are protected at the time of the event that left them there
+        for walker in System_state.first_passage.walkers.values():
+            assert walker.start_time <= System_state.time <= walker.exit_time
+
+
+def plane_distance(idx_origin,idx_destination,System_state):
+
+    # Number of jumps in the plane between two sites
+    distance = 0
+    visited = {idx_origin}
+    ring = [idx_origin]
+    while idx_destination not in visited:
+        ring = [site_idx for idx in ring for site_idx,num_event in System_state.grid_crystal[idx].migration_paths['Plane']
+                if site_idx not in visited]
+        visited.update(ring)
+        distance += 1
+    return distance
+
+def protected_adatom(System_state,rng):
+
+    # Adatom on the substrate with a protective domain (not every site has one)
+    first_passage = System_state.first_passage
+    while True:
+        idx = System_state.adsorption_sites.random_choice(rng)
+        System_state.processes((0,idx,System_state.num_event - 1,idx))
+        if first_passage.protect(idx,System_state,rng,System_state.time):
+            return idx,first_passage.walkers[idx]
+        remove_adatom(idx,System_state)
+
+def remove_adatom(idx,System_state):
+
+    update_specie_events,update_supp_av = System_state.remove_specie_site(idx,set(),set())
+    System_state.update_sites(update_specie_events,update_supp_av)
+
+def test_walker_exits_at_the_border_of_its_domain(lattice,rng):
+
+    System_state = lattice((30,30,8))
+    System_state.first_passage = First_Passage(True)
+    first_passage = System_state.first_passage
+
+    for i in range(20):
+        idx,walker = protected_adatom(System_state,rng)
+        idx_exit = first_passage.exit(walker,System_state)
+
+        assert plane_distance(idx,idx_exit,System_state) == walker.radius
+        assert idx_exit in walker.domain
+        assert System_state.grid_crystal[idx_exit].chemical_specie != 'Empty'
+        assert System_state.grid_crystal[idx].chemical_specie == 'Empty'
+        assert not first_passage.walkers and not first_passage.domain_index
+        remove_adatom(idx_exit,System_state)
+
+def test_walker_placed_inside_its_domain(lattice,rng):
+
+    System_state = lattice((30,30,8))
+    System_state.first_passage = First_Passage(True)
+    first_passage = System_state.first_passage
+
+    # Before any jump the walker is where it was protected
+    idx,walker = protected_adatom(System_state,rng)
+    assert first_passage.place(walker,walker.start_time,System_state,rng) == idx
+    assert not first_passage.walkers
+    remove_adatom(idx,System_state)
+
+    # Between the protection and the exit it has not reached the border
+    for i in range(20):
+        idx,walker = protected_adatom(System_state,rng)
+        time = walker.start_time + rng.random() * (walker.exit_time - walker.start_time)
+        idx_placed = first_passage.disrupt((0,idx,System_state.num_event - 1,idx),time,System_state,rng)[0]
+
+        assert plane_distance(idx,idx_placed,System_state) < walker.radius
+        assert idx_placed in walker.domain
+        assert System_state.grid_crystal[idx_placed].chemical_specie != 'Empty'
+        assert not first_passage.walkers and not first_passage.domain_index
+        remove_adatom(idx_placed,System_state)
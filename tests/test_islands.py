@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+Islands of the island tracker against the search over the whole lattice
+"""
+import numpy as np
+import pytest
+
+from conftest import random_step
+
+
+def reference_islands(System_state):
+
+    # Search of the islands from the occupied sites of each layer that is not complete
+    # Nearest neighbors in both directions (not symmetric at the periodic boundaries)
+    grid_crystal = System_state.grid_crystal
+    neighbors = {idx:set(site.nearest_neighbors_idx) for idx,site in grid_crystal.items()}
+    for idx,site in grid_crystal.items():
+        for neighbor in site.nearest_neighbors_idx:
+            neighbors[neighbor].add(idx)
+
+    def search(start,connected):
+        sites = set(start)
+        stack = list(start)
+        while stack:
+            idx = stack.pop()
+            for neighbor in neighbors[idx]:
+                if neighbor not in sites and neighbor in System_state.sites_occupied and connected(idx,neighbor):
+                    sites.add(neighbor)
+                    stack.append(neighbor)
+        return sites
+
+    normalized_layers = [count / System_state.sites_per_layer for count in System_state.occupancy_layers]
+    same_layer = lambda idx,neighbor: System_state.layer_index(idx) == System_state.layer_index(neighbor)
+    total_visited = set()
+    islands = set()
+
+    for z_idx in np.where(np.array(normalized_layers) != 1.0)[0]:
+        for idx_site in System_state.sites_occupied:
+            if System_state.layer_index(idx_site) != z_idx or idx_site in total_visited: continue
+            # Occupied sites of the layer connected to this one and the full island
+            island_sites = search(search([idx_site],same_layer),lambda idx,neighbor: True)
+            total_visited |= island_sites
+            islands.add((int(z_idx),frozenset(island_sites)))
+
+    return islands
+
+def tracker_islands(System_state):
+    System_state.islands_analysis()
+    return {(island.z_starting_position,frozenset(island.island_sites)) for island in System_state.islands_list}
+
+@pytest.mark.parametrize('complete_layer',[False,True])
+def test_islands_match_search(lattice,rng,complete_layer):
+
+    System_state = lattice()
+    if complete_layer:
+        System_state.deposition_sites([idx for idx in System_state.adsorption_sites if System_state.layer_index(idx) == 0])
+        # sites_per_layer is the average over the z_step levels: the sites of the first layer
+        System_state.sites_per_layer = System_state.occupancy_layers[0]
+
+    for step in range(200):
+        # The complete layer is kept
+        random_step(System_state,rng,removable = lambda idx: not (complete_layer and System_state.layer_index(idx) == 0))
+
+        if step % 20 == 0:
+            assert tracker_islands(System_state) == reference_islands(System_state)
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental occupancy per layer against a full recomputation
+"""
+from collections import Counter
+
+from conftest import random_step
+
+
+def test_incremental_layers_match_recomputation(lattice,rng):
+
+    System_state = lattice()
+    for step in range(300):
+        random_step(System_state,rng)
+
+        if step % 20 == 0:
+            layers = Counter(System_state.layer_index(idx) for idx in System_state.grid_crystal
+                             if System_state.grid_crystal[idx].chemical_specie != 'Empty')
+            assert System_state.occupancy_layers == [layers.get(z_idx,0) for z_idx in range(System_state.z_steps)]
+
+            incremental = System_state.occupancy_layers.copy()
+            System_state.layers_occupancy()
+            assert System_state.occupancy_layers == incremental
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+Random buffer: same numbers as the Generator and checkpoint/restart
+"""
+import pickle
+
+import numpy as np
+
+from KMC import KMC
+from random_buffer import Random_Buffer
+
+
+def draw(rng,n):
+
+    # Uniforms, exponentials and calls that go directly to the Generator
+    return [(rng.random(),rng.exponential(),rng.integers(100),tuple(rng.random(3))) for i in range(n)]
+
+def test_same_seed_same_sequence():
+
+    rng_1 = Random_Buffer(np.random.default_rng(7),block_size = 16)
+    rng_2 = Random_Buffer(np.random.default_rng(7),block_size = 16)
+    assert draw(rng_1,50) == draw(rng_2,50)
+
+    # The first block is the first uniforms of the Generator
+    generator = np.random.default_rng(7)
+    assert np.array_equal(Random_Buffer(np.random.default_rng(7),block_size = 16).random(16),generator.random(16))
+
+def test_pickle_round_trip():
+
+    rng = Random_Buffer(np.random.default_rng(7),block_size = 16)
+    draw(rng,25) # In the middle of a block, after several refills
+    restart = pickle.loads(pickle.dumps(rng))
+
+    assert restart.uniform_position == rng.uniform_position
+    assert restart.exponential_position == rng.exponential_position
+    assert draw(restart,50) == draw(rng,50)
+
+    # The blocks are drawn again, not saved
+    state = rng.__getstate__()
+    assert 'uniforms' not in state and 'exponentials' not in state
+
+def test_kmc_restart_is_reproducible(lattice):
+
+    System_state = lattice((15,15,12))
+    System_state.superbasin_telemetry.verbose = False
+    rng = Random_Buffer(np.random.default_rng(3),block_size = 64)
+    for step in range(100):
+        System_state,time_step = KMC(System_state,rng)
+
+    System_state_restart,rng_restart = pickle.loads(pickle.dumps((System_state,rng)))
+    for step in range(200):
+        System_state,time_step = KMC(System_state,rng)
+        System_state_restart,time_step_restart = KMC(System_state_restart,rng_restart)
+        assert time_step == time_step_restart
+
+    assert System_state.time == System_state_restart.time
+    assert set(System_state.sites_occupied) == set(System_state_restart.sites_occupied)
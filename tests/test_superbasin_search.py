@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""
+Parallel superbasin search against the serial one
+"""
+import copy
+
+import initialization
+from initialization import search_superbasin
+from superbasin import Superbasin
+
+
+def test_parallel_search_keeps_serial_superbasins(lattice,rng,monkeypatch):
+
+    System_state = lattice((20,20,20))
+    System_state.superbasin_telemetry.verbose = False
+    for i in range(200):
+        idx = System_state.adsorption_sites.random_choice(rng)
+        System_state.processes((0,idx,System_state.num_event - 1,idx))
+    System_state.E_min = 0.3
+
+    # Some of the candidates build overlapping superbasins
+    superbasins = [Superbasin(idx,System_state,System_state.E_min) for idx in System_state.energy_index.query(System_state.E_min)]
+    environments = [superbasin.superbasin_environment for superbasin in superbasins if superbasin.valid]
+    assert any(not environments[i].isdisjoint(environments[j]) for i in range(len(environments)) for j in range(i))
+
+    serial = copy.deepcopy(System_state)
+    search_superbasin(serial,use_parallel = False)
+
+    # Two processes and each candidate in its own group: overlapping candidates in different batches
+    parallel = copy.deepcopy(System_state)
+    parallel.get_num_cores = lambda: 2
+    monkeypatch.setattr(initialization,'candidate_groups',lambda candidates,System_state: [[idx] for idx in candidates])
+    search_superbasin(parallel,use_parallel = True)
+
+    assert serial.superbasin_dict.keys() == parallel.superbasin_dict.keys()
+    environments = [superbasin.superbasin_environment for superbasin in parallel.superbasin_dict.values()]
+    assert all(environments[i].isdisjoint(environments[j]) for i in range(len(environments)) for j in range(i))
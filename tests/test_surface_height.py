@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental surface height map against a full recomputation
+"""
+import numpy as np
+
+from conftest import random_step
+
+
+def surface_coord(System_state):
+    x,y,z = System_state.obtain_surface_coord()
+    return np.column_stack((x,y,z))
+
+def test_incremental_surface_matches_recomputation(lattice,rng):
+
+    System_state = lattice()
+    for step in range(300):
+        random_step(System_state,rng)
+
+        if step % 20 == 0:
+            incremental = surface_coord(System_state)
+            System_state.surface_height_map()
+            np.testing.assert_allclose(incremental,surface_coord(System_state))
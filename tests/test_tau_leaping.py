@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+Adsorption leaps: Binomial number of adsorbed particles and hybrid tau-leaping
+"""
+import numpy as np
+
+from KMC import KMC,adsorption_leap
+
+
+def test_adsorption_leap_is_binomial(lattice,rng):
+
+    System_state = lattice((30,30,8))
+    System_state.superbasin_telemetry.verbose = False
+    adsorption_sites = set(System_state.adsorption_sites)
+    n_sites = len(adsorption_sites)
+
+    # No time, no adsorption
+    assert adsorption_leap(System_state,0,rng) == []
+
+    # Probability p that a site receives some particle within the leap
+    p = 0.05
+    time_step = -np.log(1 - p) / System_state.TR_gen
+    sites = adsorption_leap(System_state,time_step,rng)
+
+    assert abs(len(sites) - n_sites * p) < 5 * np.sqrt(n_sites * p * (1 - p))
+    assert len(set(sites)) == len(sites) and set(sites) <= adsorption_sites
+    assert all(System_state.grid_crystal[idx].chemical_specie != 'Empty' for idx in sites)
+    assert set(sites) <= set(System_state.sites_occupied)
+    assert all(System_state.grid_crystal[idx].chemical_specie == 'Empty' for idx in System_state.adsorption_sites)
+
+def test_hybrid_leap_is_bounded_by_tau(lattice,rng):
+
+    System_state = lattice((30,30,8))
+    System_state.superbasin_telemetry.verbose = False
+    System_state.tau_leaping = 0.02
+    tau = System_state.tau_leaping / System_state.TR_gen
+
+    n_particles = len(System_state.sites_occupied)
+    expected = 0
+    variance = 0
+    for step in range(200):
+        time = System_state.time
+        n_sites = len(System_state.adsorption_sites)
+        System_state,time_step = KMC(System_state,rng)
+
+        assert 0 < time_step <= tau * (1 + 1e-12)
+        assert np.isclose(System_state.time,time + time_step)
+        p = 1 - np.exp(-System_state.TR_gen * time_step)
+        expected += n_sites * p
+        variance += n_sites * p * (1 - p)
+
+    # Particles adsorbed: TR_gen per adsorption site during each leap
+    assert abs(len(System_state.sites_occupied) - n_particles - expected) < 5 * np.sqrt(variance)